@@ -0,0 +1,823 @@
+#!/usr/bin/env python3
+########################################################################
+########################################################################
+"""
+##                        benchmark_energymicro
+##
+## Benchmark harness for csv2kicad_energymicro.
+##
+## Converts a corpus of device CSV files - the included CSV_Symbols.zip
+## by default, and/or synthetic corpora of generated devices - both end
+## to end and stage by stage, and reports as JSON:
+## - wall time of each stage, summed over all devices:
+##   read (Stage 1), tidy (Stages 2 & 3), place (Stage 4),
+##   boxes (Stage 5) and write (rendering and writing the output),
+## - end to end wall time, with throughput in devices/sec and pins/sec,
+## - peak memory (resident set size) of the process so far,
+## - with --memory, the peak memory traced during an end to end run.
+##   Comparing corpora of different sizes shows whether memory use is
+##   bounded by the largest device, or grows with the corpus.
+## - with --startup, the cold start time of importing the converter and
+##   of running its command line, against the start-up budget.
+## - with --kicad-sym, the time to render, and the size of, the .kicad_sym
+##   symbol library against the legacy LIB and DCM files, for each
+##   corpus.
+##
+## Example - the bundled corpus, plus 10000 devices of 400 pins each:
+##   benchmark_energymicro.py --synthetic 10000 400 -o bench.json
+##
+## Example - the pin sort alone, for 400 and 1000 pin devices:
+##   benchmark_energymicro.py --no-zip --sort 400 --sort 1000
+##
+## Example - memory use of 100 and 2000 devices of 400 pins each:
+##   benchmark_energymicro.py --no-zip --memory --synthetic 100 400 \
+##     --synthetic 2000 400
+##
+## Example - pin layout alone, per pin and in bulk (NumPy), for 100 to
+## 3000 pin devices:
+##   benchmark_energymicro.py --no-zip --layout 100 --layout 400 \
+##     --layout 1000 --layout 3000
+##
+## Example - the .kicad_sym output compared with the LIB and DCM output,
+## for 100 devices of 400 pins each:
+##   benchmark_energymicro.py --no-zip --kicad-sym --synthetic 100 400
+##
+## Example - start-up time only:
+##   benchmark_energymicro.py --no-zip --startup
+##
+## Rather than benchmark, --check-golden, --check-reproducible and
+## --check-merge check the output of the converter, exiting with status
+## 1 on any failure:
+##   benchmark_energymicro.py --check-golden --check-reproducible \
+##     --check-merge -j 4
+##
+"""
+########################################################################
+########################################################################
+# IMPORT >
+import os, sys, argparse, csv, json, shutil, tempfile, time, platform
+import random, re, subprocess, hashlib
+
+import csv2kicad_energymicro as c2k
+
+try:
+  import resource
+except ImportError: # Not available on Windows
+  resource = None
+
+import tracemalloc
+
+########################################################################
+# EXPORT >
+__version__ = c2k.__version__
+
+########################################################################
+# SYNTHETIC DEVICES >
+
+# Power pins of a synthetic device - a superset of those found in the
+# included data, so every Unit 4 placement rule is exercised
+synthetic_power_pins = ['RESETn', 'DECOUPLE', 'VDD_DREG', 'VSS_DREG',
+                        'USB_VBUS', 'USB_VREGI', 'USB_VREGO'] + \
+                       ['AVDD_%d' % n for n in range(3)] + \
+                       ['AVSS_%d' % n for n in range(3)] + \
+                       ['IOVDD_%d' % n for n in range(7)] + \
+                       ['VSS'] * 8
+
+synthetic_ports = ['PA', 'PB', 'PC', 'PD', 'PE', 'PF']
+
+def synthetic_csv(part_name, pin_count):
+  """
+  Return the text of a device CSV file with (at least) pin_count pins,
+  in the Energy Micro layout. GPIO pins are spread evenly over ports PA
+  to PF, each with a few alternate functions. Beyond 100 pins per port
+  (PA0 to PA99), the remaining pins are further VSS pins - as on a
+  large BGA.
+  """
+  gpio_count = max(pin_count - len(synthetic_power_pins), 0)
+  # At most 100 pins per port (PA0 to PA99)
+  per_port = min(-(-gpio_count // len(synthetic_ports)), 100)
+  extra_vss = max(gpio_count - per_port * len(synthetic_ports), 0)
+
+  lines = ['//' + '-' * 68,
+           '// Part name;%s' % part_name,
+           '// Chip name;Synthetic Gecko',
+           '// Package;BGA%d' % pin_count,
+           '// Package type;BGA',
+           '// Pin count;%d' % pin_count,
+           '// Package dimensions;20mm x 20mm',
+           '//' + '-' * 68,
+           '// Pins',
+           '// Pin id;Pin name;Pin type;Functionality']
+
+  pin_id = 0
+  for port in synthetic_ports:
+    for n in range(per_port):
+      pin_id += 1
+      lines.append('%d;%s%d;Unknown;TIM%d_CC%d #%d,%d / US%d_TX #%d / '
+                   'LCD_SEG%d' % (pin_id, port, n, n % 4, n % 3, n % 5,
+                                  n % 7, n % 3, n % 6, n))
+
+  for name in synthetic_power_pins + ['VSS'] * extra_vss:
+    pin_id += 1
+    if name == 'RESETn':
+      lines.append('%d;%s;Passive;' % (pin_id, name))
+    else:
+      lines.append('%d;%s;Power;' % (pin_id, name))
+
+  return '\r\n'.join(lines) + '\r\n'
+
+def write_synthetic_corpus(directory, devices, pin_count):
+  """
+  Write 'devices' synthetic device CSV files to the directory, and
+  return their names.
+  """
+  f_in_list = []
+  for n in range(devices):
+    f_in = os.path.join(directory, 'SYN%05dP%d.csv' % (n, pin_count))
+    with open(f_in, 'w', newline='') as f:
+      f.write(synthetic_csv('SYN%05dP%d' % (n, pin_count), pin_count))
+    f_in_list.append(f_in)
+  return f_in_list
+
+########################################################################
+# MEASUREMENT >
+
+def peak_memory_kb():
+  """
+  Peak resident set size of this process so far, in KiB (or None).
+  """
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # (reported in bytes on Mac OS X, and KiB elsewhere)
+  if sys.platform == 'darwin':
+    peak //= 1024
+  return peak
+
+def rate(count, seconds):
+  """
+  Return count/seconds, or None if no time was measured.
+  """
+  if seconds <= 0:
+    return None
+  return count / seconds
+
+def benchmark_stages(f_in_list, out_dir):
+  """
+  Convert each device one stage at a time, returning the wall time of
+  each stage summed over all devices, and the total number of pins.
+  """
+  stages = dict((name, 0.0) for name in
+                ('read', 'tidy', 'place', 'boxes', 'write'))
+  pin_total = 0
+
+  # (start each run as the command line does, with no pins tidied yet)
+  c2k.pin_fields.clear()
+
+  with c2k.LibraryWriter(os.path.join(out_dir, 'stages.lib'),
+                         os.path.join(out_dir, 'stages.dcm')) as writer:
+    for f_in in f_in_list:
+      t0 = time.time()
+      # (read all rows up front, to time Stage 1 on its own)
+      with c2k.open_device_csv(f_in) as f:
+        rows = csv.reader(f, delimiter=';')
+        header = c2k.read_device_header(rows)
+        rows = list(rows)
+      t1 = time.time()
+      pins = c2k.tidy_pins(rows)
+      t2 = time.time()
+      units, unit_count = c2k.partition_units(pins)
+      vss_max = c2k.place_pins(units)
+      t3 = time.time()
+      c2k.build_units(units, vss_max)
+      t4 = time.time()
+      component = c2k.Component(*(header + (units, unit_count)))
+      writer.write_component(c2k.render_lib_body(component),
+                             c2k.render_dcm_body(component))
+      t5 = time.time()
+
+      stages['read'] += t1 - t0
+      stages['tidy'] += t2 - t1
+      stages['place'] += t3 - t2
+      stages['boxes'] += t4 - t3
+      stages['write'] += t5 - t4
+      pin_total += len(pins)
+
+  return stages, pin_total
+
+def benchmark_end_to_end(f_in_list, out_dir, jobs):
+  """
+  Convert all devices as the command line does, returning the wall time.
+  """
+  c2k.pin_fields.clear()
+  t0 = time.time()
+  with c2k.LibraryWriter(os.path.join(out_dir, 'e2e.lib'),
+                         os.path.join(out_dir, 'e2e.dcm')) as writer:
+    if jobs > 1:
+      c2k.efm2kicad_batch(f_in_list, jobs, writer)
+    else:
+      for f_in in f_in_list:
+        c2k.efm2kicad_generator(f_in, writer)
+  return time.time() - t0
+
+def benchmark_memory(f_in_list, out_dir):
+  """
+  Convert all devices as the command line does, returning the peak
+  memory traced, in KiB.
+  """
+  tracemalloc.start()
+  try:
+    benchmark_end_to_end(f_in_list, out_dir, 1)
+    peak = tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+  return peak // 1024
+
+def benchmark_corpus(name, f_in_list, repeat, jobs, memory=False):
+  """
+  Benchmark one corpus, returning its results. The best (lowest) time
+  of 'repeat' runs is reported for each measurement.
+  """
+  out_dir = tempfile.mkdtemp(prefix='c2k-bench-')
+  try:
+    best_stages = None
+    best_e2e = None
+    for n in range(repeat):
+      stages, pin_total = benchmark_stages(f_in_list, out_dir)
+      if best_stages is None:
+        best_stages = stages
+      else:
+        for stage in stages:
+          best_stages[stage] = min(best_stages[stage], stages[stage])
+      e2e = benchmark_end_to_end(f_in_list, out_dir, jobs)
+      if best_e2e is None or e2e < best_e2e:
+        best_e2e = e2e
+    if memory:
+      peak_traced_kb = benchmark_memory(f_in_list, out_dir)
+  finally:
+    shutil.rmtree(out_dir)
+
+  devices = len(f_in_list)
+  results = {
+    'corpus': name,
+    'devices': devices,
+    'pins': pin_total,
+    'stages': dict((stage, {'seconds': seconds,
+                            'devices_per_sec': rate(devices, seconds),
+                            'pins_per_sec': rate(pin_total, seconds)})
+                   for stage, seconds in best_stages.items()),
+    'end_to_end': {'seconds': best_e2e,
+                   'jobs': jobs,
+                   'devices_per_sec': rate(devices, best_e2e),
+                   'pins_per_sec': rate(pin_total, best_e2e)},
+    'peak_memory_kb': peak_memory_kb(),
+  }
+  if memory:
+    results['peak_traced_memory_kb'] = peak_traced_kb
+  return results
+
+# Cold start budget, in seconds, for importing the converter and for
+# running its command line (-h) - over the start-up of the interpreter
+# itself, which is measured alongside.
+startup_budget = {'import': 0.050, 'help': 0.100}
+
+def benchmark_startup(repeat):
+  """
+  Time fresh interpreters importing csv2kicad_energymicro, and running
+  its command line with -h, returning the best time of each (less that
+  of a bare interpreter), and whether it is within startup_budget.
+  """
+  script = os.path.abspath(c2k.__file__)
+  commands = {
+    'python': [sys.executable, '-c', 'pass'],
+    'import': [sys.executable, '-c', 'import csv2kicad_energymicro'],
+    'help': [sys.executable, script, '-h'],
+  }
+  best = {}
+  with open(os.devnull, 'w') as devnull:
+    for name, command in commands.items():
+      for n in range(repeat):
+        t0 = time.time()
+        subprocess.check_call(command, stdout=devnull,
+                              cwd=os.path.dirname(script))
+        seconds = time.time() - t0
+        if name not in best or seconds < best[name]:
+          best[name] = seconds
+
+  results = {'python_seconds': best['python']}
+  for name in startup_budget:
+    seconds = max(best[name] - best['python'], 0.0)
+    results[name] = {'seconds': seconds,
+                     'budget_seconds': startup_budget[name],
+                     'within_budget': seconds <= startup_budget[name]}
+  return results
+
+########################################################################
+# COMPARISONS >
+
+def legacy_sort_table(table, cols):
+  """
+  The sort_table of csv2kicad_energymicro v0.4: one natural sort per
+  column, each rebuilding its keys with re.split. For comparison only.
+  """
+  def natural_sort(list, key):
+    convert = lambda text: int(text) if text.isdigit() else text
+    list.sort(key=lambda s: [convert(c) for c in
+                             re.split('([0-9]+)', key(s))])
+  for col in reversed(cols):
+    natural_sort(table, key=lambda x: str(getattr(x, col)))
+  return table
+
+def benchmark_sort(pin_count, tables, repeat):
+  """
+  Sort 'tables' shuffled copies of a synthetic pin table of pin_count
+  pins, with both sort_table and legacy_sort_table, returning the best
+  time of each. The sort key cache is cleared before each run, so it
+  only benefits from names repeated within the run - as from device to
+  device.
+  """
+  rows = csv.reader(synthetic_csv('SORT', pin_count).splitlines(),
+                    delimiter=';')
+  c2k.read_device_header(rows)
+  pins = c2k.tidy_pins(rows)
+
+  shuffler = random.Random(pin_count)
+  inputs = []
+  for n in range(tables):
+    table = list(pins)
+    shuffler.shuffle(table)
+    inputs.append(table)
+
+  results = {}
+  for name, sort in (('sort_table', c2k.sort_table),
+                     ('legacy_sort_table', legacy_sort_table)):
+    best = None
+    for n in range(repeat):
+      c2k.natural_keys.clear()
+      copies = [list(table) for table in inputs]
+      t0 = time.time()
+      for table in copies:
+        sort(table, ('unit', 'name'))
+      seconds = time.time() - t0
+      if best is None or seconds < best:
+        best = seconds
+    results[name] = best
+
+  # Both must give the same order
+  expected = legacy_sort_table(list(inputs[0]), ('unit', 'name'))
+  assert c2k.sort_table(list(inputs[0]), ('unit', 'name')) == expected
+
+  return {'pins': len(pins),
+          'tables': tables,
+          'seconds': results['sort_table'],
+          'legacy_seconds': results['legacy_sort_table'],
+          'speedup': rate(results['legacy_sort_table'],
+                          results['sort_table'])}
+
+def benchmark_layout(pin_count, devices, repeat):
+  """
+  Lay out (Stages 4B and 5) 'devices' copies of a synthetic device of
+  pin_count pins, both pin by pin (place_pins, build_units) and in bulk
+  (place_pins_bulk, build_units_bulk), returning the best time of each.
+  """
+  text = synthetic_csv('LAYOUT', pin_count)
+
+  def fresh_units():
+    # (partitioned here, as both paths share partition_units)
+    rows = csv.reader(text.splitlines(), delimiter=';')
+    header = c2k.read_device_header(rows)
+    return header, c2k.partition_units(c2k.tidy_pins(rows))
+
+  def lay_out(place, boxes, units):
+    boxes(units, place(units))
+
+  results = {}
+  for name, place, boxes in (
+      ('per_pin', c2k.place_pins, c2k.build_units),
+      ('bulk', c2k.place_pins_bulk, c2k.build_units_bulk)):
+    best = None
+    for n in range(repeat):
+      inputs = [fresh_units()[1][0] for device in range(devices)]
+      t0 = time.time()
+      for units in inputs:
+        lay_out(place, boxes, units)
+      seconds = time.time() - t0
+      if best is None or seconds < best:
+        best = seconds
+    results[name] = best
+
+  # Both must give the same component
+  outputs = []
+  for place, boxes in ((c2k.place_pins, c2k.build_units),
+                       (c2k.place_pins_bulk, c2k.build_units_bulk)):
+    header, (units, unit_count) = fresh_units()
+    lay_out(place, boxes, units)
+    component = c2k.Component(*(header + (units, unit_count)))
+    outputs.append(c2k.render_lib_body(component))
+  assert outputs[0] == outputs[1]
+
+  return {'pins': sum(len(unit.pins) for unit in units),
+          'devices': devices,
+          'seconds': results['per_pin'],
+          'bulk_seconds': results['bulk'],
+          'speedup': rate(results['per_pin'], results['bulk'])}
+
+def benchmark_kicad_sym(f_in_list, repeat):
+  """
+  Render the components of the devices both as LIB and DCM text blocks
+  and as .kicad_sym symbols, returning the best time of each, and the
+  size of each complete library (with and without aliases) - the text
+  KiCad must read to load it.
+  """
+  components = [c2k.efm2kicad_component(f_in) for f_in in f_in_list]
+
+  renderers = {
+    'lib': lambda component: (c2k.render_lib_body(component),
+                              c2k.render_dcm_body(component)),
+    'kicad_sym': lambda component: (c2k.render_sym_body(component),),
+  }
+  results = {}
+  for name, render in renderers.items():
+    best = None
+    for n in range(repeat):
+      t0 = time.time()
+      for component in components:
+        render(component)
+      seconds = time.time() - t0
+      if best is None or seconds < best:
+        best = seconds
+    results[name] = best
+
+  def size(*texts):
+    return sum(len(text.encode('utf-8')) for text in texts)
+
+  sizes = {}
+  for alias in (False, True):
+    key = 'alias' if alias else 'full'
+    sizes[key] = {
+      'lib_bytes': size(c2k.render_lib(components, alias),
+                        c2k.render_dcm(components)),
+      'kicad_sym_bytes': size(c2k.render_sym(components, alias)),
+    }
+
+  return {'devices': len(components),
+          'lib_seconds': results['lib'],
+          'kicad_sym_seconds': results['kicad_sym'],
+          'lib_devices_per_sec': rate(len(components), results['lib']),
+          'kicad_sym_devices_per_sec': rate(len(components),
+                                            results['kicad_sym']),
+          'sizes': sizes}
+
+########################################################################
+# CHECKS >
+#
+# Each check returns a list of its failures - empty if it passes.
+
+def file_sha256(name):
+  """
+  Return the SHA-256 hash of a file, in hex.
+  """
+  with open(name, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+# The LIB and DCM files of the included CSV_Symbols.zip, as written by
+# v0.4 of the converter - which any change must match, component by
+# component
+golden_lib = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'golden', 'energymicro-efm32.lib')
+
+class BlockCollector(object):
+  """
+  A writer, as LibraryWriter, which keeps the LIB and DCM text blocks
+  written to it, by component name.
+  """
+
+  def __init__(self):
+    self.lib_blocks = {}
+    self.dcm_blocks = {}
+
+  def write_component(self, output_lib, output_dcm):
+    name = re.search(r'^DEF (\S+)', output_lib, re.M).group(1)
+    self.lib_blocks[name] = output_lib
+    self.dcm_blocks[name] = output_dcm
+
+def golden_blocks(name, block_re):
+  """
+  Return the text blocks of a LIB or DCM file, by component name.
+  """
+  with open(name, 'rb') as f:
+    data = f.read().replace(b'\r\n', b'\n')
+  return dict((match.group(1).decode('utf-8'),
+               match.group(0).decode('utf-8'))
+              for match in block_re.finditer(data))
+
+def check_golden(zip_name, jobs=2, lib_name=golden_lib):
+  """
+  Convert the devices of the zip archive and check that the LIB and DCM
+  text block of each is as in the golden files - converting serially,
+  again with the pin_fields cache warm, with every device laid out in
+  bulk (where NumPy is installed), and in a pool of 'jobs' worker
+  processes.
+  """
+  golden = {'LIB': golden_blocks(lib_name, c2k.lib_block_bytes_re),
+            'DCM': golden_blocks(os.path.splitext(lib_name)[0] + '.dcm',
+                                 c2k.dcm_block_bytes_re)}
+  f_in_list = c2k.zip_members(zip_name, '*.csv')
+
+  def serial(writer):
+    for f_in in f_in_list:
+      c2k.efm2kicad_generator(f_in, writer)
+
+  def bulk(writer):
+    bulk_layout_pins = c2k.bulk_layout_pins
+    c2k.bulk_layout_pins = 0
+    try:
+      serial(writer)
+    finally:
+      c2k.bulk_layout_pins = bulk_layout_pins
+
+  def parallel(writer):
+    c2k.efm2kicad_batch(f_in_list, jobs, writer)
+
+  runs = [('serial', serial), ('warm', serial), ('parallel', parallel)]
+  if c2k.numpy_or_none() is not None:
+    runs.append(('bulk', bulk))
+
+  c2k.pin_fields.clear()
+  failures = []
+  for run, convert in runs:
+    writer = BlockCollector()
+    convert(writer)
+    for kind, blocks in (('LIB', writer.lib_blocks),
+                         ('DCM', writer.dcm_blocks)):
+      for name in sorted(set(golden[kind]) | set(blocks)):
+        if name not in blocks:
+          failures.append('%s: %s: no %s block' % (run, name, kind))
+        elif name not in golden[kind]:
+          failures.append('%s: %s: %s block not in the golden file' %
+                          (run, name, kind))
+        elif blocks[name] != golden[kind][name]:
+          failures.append('%s: %s: %s block differs from the golden file'
+                          % (run, name, kind))
+  return failures
+
+# SOURCE_DATE_EPOCH of the check runs which set it
+check_epoch = '1700000000'
+
+def check_reproducible(zip_name, jobs=2):
+  """
+  Convert the zip archive twice with --reproducible - serially and in a
+  pool of 'jobs' worker processes, each with SOURCE_DATE_EPOCH unset and
+  set - and check that the SHA-256 hash of each output file is the same
+  for both runs, and for the serial and parallel runs.
+  """
+  script = os.path.abspath(c2k.__file__)
+  zip_name = os.path.abspath(zip_name)
+  work_dir = tempfile.mkdtemp(prefix='c2k-check-')
+  hashes = {}
+  try:
+    for run in (1, 2):
+      if run == 2:
+        # (so any output dated by the clock would differ)
+        time.sleep(1.1)
+      for epoch in (None, check_epoch):
+        for job_count in (1, jobs):
+          env = dict(os.environ)
+          env.pop('SOURCE_DATE_EPOCH', None)
+          if epoch is not None:
+            env['SOURCE_DATE_EPOCH'] = epoch
+          run_dir = os.path.join(work_dir, '%d-%s-%d' % (run, epoch,
+                                                         job_count))
+          os.mkdir(run_dir)
+          subprocess.check_call([sys.executable, script, '--reproducible',
+                                 '-j', str(job_count), zip_name],
+                                cwd=run_dir, env=env,
+                                stdout=subprocess.DEVNULL)
+          hashes[run, epoch, job_count] = dict(
+            (name, file_sha256(os.path.join(run_dir, name)))
+            for name in sorted(os.listdir(run_dir)))
+  finally:
+    shutil.rmtree(work_dir)
+
+  failures = []
+  for epoch in (None, check_epoch):
+    first = hashes[1, epoch, 1]
+    for key in ((2, epoch, 1), (1, epoch, jobs), (2, epoch, jobs)):
+      if hashes[key] != first:
+        failures.append('SOURCE_DATE_EPOCH=%s: run %d with %d job(s) '
+                        'differs from run 1 with 1 job: %s against %s'
+                        % (epoch, key[0], key[2], hashes[key], first))
+  return failures
+
+def check_merge(zip_name, jobs=2, lib_name=golden_lib):
+  """
+  Convert the zip archive into shards by package, and merge the golden
+  files with the shards - so every component of the shards is a
+  duplicate - checking that each component name is reported once, as
+  identical, and the merged library is as the golden files.
+  """
+  f_in_list = c2k.zip_members(zip_name, '*.csv')
+  work_dir = tempfile.mkdtemp(prefix='c2k-check-')
+  try:
+    shard_lib = os.path.join(work_dir, 'shard.lib')
+    shards = c2k.efm2kicad_shards(c2k.shard_inputs(f_in_list, 'package'),
+                                  shard_lib, jobs)
+    shard_names = set()
+    for names in shards:
+      shard_names.update(golden_blocks(names[0], c2k.lib_block_bytes_re))
+
+    merged_lib = os.path.join(work_dir, 'merged.lib')
+    merged_dcm = os.path.join(work_dir, 'merged.dcm')
+    duplicates = c2k.merge_libraries([lib_name] +
+                                     [names[0] for names in shards],
+                                     merged_lib, merged_dcm)
+    merged = {'LIB': golden_blocks(merged_lib, c2k.lib_block_bytes_re),
+              'DCM': golden_blocks(merged_dcm, c2k.dcm_block_bytes_re)}
+  finally:
+    shutil.rmtree(work_dir)
+
+  failures = []
+  duplicate_names = [duplicate[0] for duplicate in duplicates]
+  if len(duplicate_names) != len(shard_names):
+    failures.append('%d duplicate(s) reported, of %d duplicated '
+                    'component names' % (len(duplicate_names),
+                                         len(shard_names)))
+  for name in sorted(set(duplicate_names)):
+    if duplicate_names.count(name) > 1:
+      failures.append('%s: reported as a duplicate %d times' %
+                      (name, duplicate_names.count(name)))
+  for duplicate in duplicates:
+    if not duplicate[3]:
+      failures.append('%s: in %s and %s, which differ' % duplicate[:3])
+  golden = {'LIB': golden_blocks(lib_name, c2k.lib_block_bytes_re),
+            'DCM': golden_blocks(os.path.splitext(lib_name)[0] + '.dcm',
+                                 c2k.dcm_block_bytes_re)}
+  for kind in ('LIB', 'DCM'):
+    if merged[kind] != golden[kind]:
+      failures.append('merged %s file differs from the golden file'
+                      % kind)
+  return failures
+
+########################################################################
+# MAIN FUNCTION >
+
+if __name__ == "__main__" :
+
+  parser = argparse.ArgumentParser(
+  formatter_class=argparse.RawDescriptionHelpFormatter,
+  description = __doc__)
+
+  parser.add_argument('--zip', default = os.path.join(
+                      os.path.dirname(os.path.abspath(__file__)),
+                      'CSV_Symbols.zip'), help = 'Zip archive of device \
+                      csv files to benchmark. Default: the included \
+                      CSV_Symbols.zip.')
+
+  parser.add_argument('--no-zip', action = 'store_true', help = 'Only \
+                      benchmark the synthetic corpora.')
+
+  parser.add_argument('--synthetic', nargs = 2, type = int,
+                      action = 'append', default = [],
+                      metavar = ('DEVICES', 'PINS'), help = 'Also \
+                      benchmark a synthetic corpus of DEVICES devices \
+                      of PINS pins each. May be repeated.')
+
+  parser.add_argument('--sort', type = int, action = 'append',
+                      default = [], metavar = 'PINS', help = 'Also \
+                      compare sort_table with the v0.4 implementation, \
+                      on synthetic pin tables of PINS pins. May be \
+                      repeated.')
+
+  parser.add_argument('--sort-tables', type = int, default = 100,
+                      metavar = 'N', help = 'Pin tables sorted per run \
+                      of --sort. Default: 100.')
+
+  parser.add_argument('--layout', type = int, action = 'append',
+                      default = [], metavar = 'PINS', help = 'Also \
+                      compare laying out synthetic devices of PINS pins \
+                      pin by pin and in bulk (which needs NumPy). May \
+                      be repeated.')
+
+  parser.add_argument('--layout-devices', type = int, default = 20,
+                      metavar = 'N', help = 'Devices laid out per run of \
+                      --layout. Default: 20.')
+
+  parser.add_argument('--kicad-sym', action = 'store_true', help = 'Also \
+                      compare rendering each corpus as a .kicad_sym \
+                      symbol library with rendering it as LIB and DCM \
+                      files, in time and in size.')
+
+  parser.add_argument('-r', '--repeat', type = int, default = 3,
+                      help = 'Runs of each measurement; the best is \
+                      reported. Default: 3.')
+
+  parser.add_argument('-j', '--jobs', type = int, default = 1,
+                      metavar = 'N', help = 'Worker processes for the \
+                      end to end run. Default: 1.')
+
+  parser.add_argument('-m', '--memory', action = 'store_true',
+                      help = 'Also trace the peak memory of a serial end \
+                      to end run of each corpus.')
+
+  parser.add_argument('--startup', action = 'store_true', help = 'Also \
+                      time the cold start of importing the converter \
+                      and of running its command line, against the \
+                      start-up budget.')
+
+  parser.add_argument('--check-golden', action = 'store_true', help = \
+                      'Rather than benchmark, check that the LIB and DCM \
+                      text block of each device of the --zip corpus is \
+                      as in golden/energymicro-efm32.lib and .dcm - as \
+                      converted serially, with warm caches, in bulk and \
+                      with --jobs (at least 2). Exits with status 1 on \
+                      any failure.')
+
+  parser.add_argument('--check-reproducible', action = 'store_true',
+                      help = 'Rather than benchmark, check that two \
+                      --reproducible conversions of the --zip corpus \
+                      write output of the same SHA-256 hashes - \
+                      serially and with --jobs (at least 2), with \
+                      SOURCE_DATE_EPOCH unset and set. Exits with \
+                      status 1 on any failure.')
+
+  parser.add_argument('--check-merge', action = 'store_true', help = \
+                      'Rather than benchmark, check that merging the \
+                      golden files with the --zip corpus converted \
+                      into shards by package (with --jobs, at least 2) \
+                      reports each component once, as an identical \
+                      duplicate, and leaves the golden files as they \
+                      are. Exits with status 1 on any failure.')
+
+  parser.add_argument('-o', '--output', help = 'Write the JSON report \
+                      to this file, rather than to stdout.')
+
+  arguments = parser.parse_args()
+
+  checks = []
+  if arguments.check_golden:
+    checks.append(('golden', lambda: check_golden(
+                   arguments.zip, max(arguments.jobs, 2))))
+  if arguments.check_reproducible:
+    checks.append(('reproducible', lambda: check_reproducible(
+                   arguments.zip, max(arguments.jobs, 2))))
+  if arguments.check_merge:
+    checks.append(('merge', lambda: check_merge(
+                   arguments.zip, max(arguments.jobs, 2))))
+
+  if checks:
+    status = 0
+    for name, check in checks:
+      failures = check()
+      for failure in failures:
+        print('%s: %s' % (name, failure))
+      print('%s: %s' % (name, 'FAILED' if failures else 'OK'))
+      if failures:
+        status = 1
+    sys.exit(status)
+
+  report = {'python': platform.python_version(),
+            'csv2kicad_version': c2k.__version__,
+            'corpora': [],
+            'sort': [],
+            'layout': []}
+
+  def benchmark_all(name, f_in_list):
+    corpus = benchmark_corpus(name, f_in_list, arguments.repeat,
+                              arguments.jobs, arguments.memory)
+    if arguments.kicad_sym:
+      corpus['kicad_sym'] = benchmark_kicad_sym(f_in_list,
+                                                arguments.repeat)
+    report['corpora'].append(corpus)
+
+  if not arguments.no_zip:
+    benchmark_all(os.path.basename(arguments.zip),
+                  c2k.zip_members(arguments.zip, '*.csv'))
+
+  for devices, pin_count in arguments.synthetic:
+    corpus_dir = tempfile.mkdtemp(prefix='c2k-synthetic-')
+    try:
+      f_in_list = write_synthetic_corpus(corpus_dir, devices, pin_count)
+      benchmark_all('synthetic-%dx%d' % (devices, pin_count), f_in_list)
+    finally:
+      shutil.rmtree(corpus_dir)
+
+  for pin_count in arguments.sort:
+    report['sort'].append(benchmark_sort(pin_count, arguments.sort_tables,
+                                         arguments.repeat))
+
+  for pin_count in arguments.layout:
+    report['layout'].append(benchmark_layout(pin_count,
+                                             arguments.layout_devices,
+                                             arguments.repeat))
+
+  if arguments.startup:
+    report['startup'] = benchmark_startup(max(arguments.repeat, 5))
+
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if arguments.output:
+    with open(arguments.output, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+
+########################################################################
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 ########################################################################
 ########################################################################
 """
@@ -94,35 +94,31 @@
 ## 0.1   2012-06-18 - Initial version.
 ##
 ## TODO:
-## - Utilise the KiCad component 'alias' function to reduce output file-
-##   size.
 ## - Impart more data to DCM file as and when it becomes available in
 ##   easily processed form from Energy Micro.
-## - Investigate using a python dictionary function in place of the
-##   'collection of fixed-position pins' for Unit 4 pin arrangement -
-##   probably of more relevance to repurposing this script.
 ##
 ########################################################################
 ########################################################################
 # IMPORT >
-import os, sys, argparse, re, csv, datetime
+# Only what converting a device needs is imported here. The modules used
+# by the command line and by optional features (zip input, --jobs,
+# --cache, --profile...) are imported where they are used, to keep
+# start-up fast when run (or imported) thousands of times by a build.
+import os, sys, re, csv
+from timeit import default_timer
 from collections import Counter
-from itertools import groupby
+from itertools import chain, groupby, islice
 
 ########################################################################
 # EXPORT >
 __author__ = "Hamish Mead (info at meadtimemachines dot co dot uk)"
 __version__ = "0.4"
 
-########################################################################
-# DEBUG > Print Additional Debug Messages
-# if needed, make _debugflag = 1 for verbose, or 2 for limited.
-# Note that 2 requires local editing of "_debugflag == x" lines
-_debugflag = 2
-
 ########################################################################
 # GLOBAL VARIABLES >
-header_flag = 0
+# Zip archives opened for reading device CSV files, by archive name and
+# process id
+zip_archives = {}
 
 ########################################################################
 # TEMPLATES >
@@ -135,7 +131,7 @@ template_lib_header = """EESchema-LIBRARY Version 2.3 Date: {dtg}
 
 template_lib_body = """# {compname}
 #
-DEF {compname} U 0 40 Y Y 4 L N
+DEF {compname} U 0 40 Y Y {unitcount} L N
 F0 "U" {refposx} {refposy} 60 H V L BNN
 F1 "{compname}" {nameposx} {nameposy} 60 H V L BNN
 $FPLIST
@@ -156,205 +152,871 @@ template_dcm_header = """EESchema-DOCLIB  Version 2.0  Date: {dtg}
 """
 
 template_dcm_body = """$CMP {compname}
-D Family: {chipname}, Package: {footprint}, Package size: {fpsize}
-K Energy Micro energymicro EFM32 32bit ARM Cortex Flash Microcontroller MCU
-F http://www.energymicro.com/downloads/datasheets
+D {description}
+K {keywords}
+F {datasheet}
 $ENDCMP
 #
 """
 
+# The documentation of each component - written to the DCM file, or to
+# the properties of a .kicad_sym symbol
+template_description = \
+  "Family: {chipname}, Package: {footprint}, Package size: {fpsize}"
+component_keywords = \
+  "Energy Micro energymicro EFM32 32bit ARM Cortex Flash Microcontroller MCU"
+component_datasheet = "http://www.energymicro.com/downloads/datasheets"
+
 template_dcm_footer = """# End Doc Library
 """
 
+########################################################################
+# LAYOUT >
+
+# Unit 4 (only) has a fixed width
+unit4_width = 1000
+
+pin_length = 300
+
+# Location of first pin in each Unit group
+pin_y_spacing = 100
+
+# Y offset from top & bottom pins to top or bottom of Unit box outline
+pin_y_box_offset = 150
+
+########################################################################
+# POWER UNIT LAYOUT >
+#
+# The pins of Unit 4 (power) are placed by a table of rules, rather than
+# in alphanumeric order. Each rule matches pins by exact name (first) or
+# by name prefix (the longest matching prefix), and places them on the
+# left or right side of the unit, at a row given by an expression such
+# as 'max + 3 + 2*VSS_DREG? + n'. Its terms, added or subtracted, are
+# whole numbers, optionally multiplying one of:
+#   n       - the number of pins of the rule's group placed before it,
+#   GROUP   - the number of pins in a group,
+#   GROUP?  - 1 if there are any pins in a group, otherwise 0,
+#   max     - the largest of the table's 'max' expressions.
+# A rule's group is its name or prefix, unless another is given. A rule
+# may also replace the pin's name, electrical type or shape.
+#
+# The table may be loaded from a JSON file of the same structure (see
+# load_power_layout), for other pin sets.
+
+power_layout_table = {
+  # Rows occupied by the AVDD_n pins (and USB pins above them, if any) on
+  # the left, and by the IOVDD_n pins on the right: the VSS pins follow
+  'max': ['7*USB? + 4 + AVDD', '6 + IOVDD'],
+  'rules': [
+    # (double '~' displays vinculum over pin name; P=Passive, I=Inv.Pin)
+    {'name': 'RESETn', 'side': 'left', 'row': '0',
+     'rename': '~RESET~', 'elec_type': 'P', 'shape': 'I'},
+    {'name': 'DECOUPLE', 'side': 'right', 'row': '0'},
+    {'prefix': 'IOVDD_', 'group': 'IOVDD', 'side': 'right',
+     'row': 'max - IOVDD + n'},
+    {'name': 'USB_VBUS', 'group': 'USB', 'side': 'left', 'row': '4'},
+    {'name': 'USB_VREGI', 'group': 'USB', 'side': 'left', 'row': '6'},
+    {'name': 'USB_VREGO', 'group': 'USB', 'side': 'left', 'row': '7'},
+    {'name': 'VDD_DREG', 'side': 'right', 'row': 'max - IOVDD - 2'},
+    {'name': 'VSS_DREG', 'side': 'right', 'row': 'max + 3'},
+    {'name': 'VSS', 'side': 'right', 'row': 'max + 3 + 2*VSS_DREG? + n'},
+    # Any other VSS pins, eg VSS_PAD, below the VSS pins
+    {'prefix': 'VSS', 'group': 'VSS_n', 'side': 'right',
+     'row': 'max + 3 + 2*VSS_DREG? + VSS + n'},
+    {'prefix': 'AVDD_', 'group': 'AVDD', 'side': 'left',
+     'row': 'max - AVDD + n'},
+    # (level with the last VSS pin)
+    {'prefix': 'AVSS_', 'group': 'AVSS', 'side': 'left',
+     'row': 'max + 3 + 2*VSS_DREG? + VSS - AVSS + n'},
+  ],
+}
+
+# One term of a row expression: sign, multiplier and value
+row_term_re = re.compile(r'\s*([+-])?\s*(?:(\d+)\s*\*\s*)?(\d+|\w+\??)\s*')
+
+def parse_row(text):
+  """
+  Parse a row expression, returning its terms as (multiplier, value)
+  pairs - the value '' for a whole number, eg:
+  'max - IOVDD + 2' gives [(1, 'max'), (-1, 'IOVDD'), (2, '')]
+  """
+  terms = []
+  position = 0
+  while position < len(text):
+    match = row_term_re.match(text, position)
+    if match is None or (terms and match.group(1) is None):
+      raise ValueError("Invalid row expression: %r" % text)
+    sign, multiplier, value = match.groups()
+    multiplier = int(multiplier or 1) * (-1 if sign == '-' else 1)
+    if value.isdigit():
+      multiplier, value = multiplier * int(value), ''
+    terms.append((multiplier, value))
+    position = match.end()
+  return terms
+
+def evaluate_row(terms, values):
+  """
+  Return the value of a parsed row expression.
+  """
+  return sum([multiplier * values[value] for multiplier, value in terms])
+
+# The fields of a power layout rule, each of them text
+power_rule_fields = ('name', 'prefix', 'group', 'side', 'row', 'rename',
+                     'elec_type', 'shape')
+
+class PowerRule(object):
+  """
+  One rule of a PowerLayout: where to place the pins it matches.
+  """
+  __slots__ = ('group', 'side', 'row', 'rename', 'elec_type', 'shape')
+
+  def __init__(self, rule):
+    if not isinstance(rule, dict):
+      raise TypeError("Power layout rule %r is not a table" % (rule,))
+    for key in power_rule_fields:
+      if key in rule and not isinstance(rule[key], str):
+        raise TypeError("Power layout rule %r: %s is not text" % (rule,
+                        key))
+    if 'name' not in rule and 'prefix' not in rule:
+      raise ValueError("Power layout rule without a name or prefix: %r"
+                       % rule)
+    self.group = rule.get('group') or rule.get('name') or rule['prefix']
+    for key in ('side', 'row'):
+      if key not in rule:
+        raise ValueError("Power layout rule for pin group %s without "
+                         "a %s" % (self.group, key))
+    self.side = rule['side']
+    if self.side not in ('left', 'right'):
+      raise ValueError("Invalid side %r for pin group %s" % (self.side,
+                       self.group))
+    self.row = parse_row(rule['row'])
+    self.rename = rule.get('rename')
+    self.elec_type = rule.get('elec_type')
+    self.shape = rule.get('shape')
+
+class PowerLayout(object):
+  """
+  A table of rules placing the pins of the power unit (Unit 4) - see
+  power_layout_table.
+  """
+
+  def __init__(self, table):
+    self.table = table
+    self.names = {}
+    self.prefixes = {}
+    if not isinstance(table, dict) or 'rules' not in table:
+      raise ValueError("Power layout table without rules")
+    if not isinstance(table['rules'], list):
+      raise TypeError("Power layout rules are not a list")
+    if not isinstance(table.get('max', []), list) or \
+       not all(isinstance(text, str) for text in table.get('max', [])):
+      raise TypeError("Power layout max rows are not a list of text")
+    for rule in table['rules']:
+      power_rule = PowerRule(rule)
+      if 'name' in rule:
+        self.names[rule['name']] = power_rule
+      else:
+        self.prefixes[rule['prefix']] = power_rule
+    # Longest first
+    self.prefix_lengths = sorted(set(len(prefix)
+                                     for prefix in self.prefixes),
+                                 reverse=True)
+    self.max_rows = [parse_row(text) for text in table.get('max', [])]
+
+    # Check every value used is defined
+    self.groups = set(rule.group for rule in self.rules())
+    known = set([''] + list(self.groups) +
+                [group + '?' for group in self.groups])
+    for terms in self.max_rows:
+      for multiplier, value in terms:
+        if value not in known:
+          raise ValueError("Unknown value %r in max row" % value)
+    known.update(('n', 'max'))
+    for rule in self.rules():
+      for multiplier, value in rule.row:
+        if value not in known:
+          raise ValueError("Unknown value %r in row of pin group %s"
+                           % (value, rule.group))
+
+  def rules(self):
+    return chain(self.names.values(), self.prefixes.values())
+
+  def rule(self, name):
+    """
+    Return the PowerRule matching a pin name, or None.
+    """
+    rule = self.names.get(name)
+    if rule is None:
+      for length in self.prefix_lengths:
+        rule = self.prefixes.get(name[:length])
+        if rule is not None:
+          break
+    return rule
+
+  def values(self, rules):
+    """
+    Return the values of row expressions for a device, given the rule
+    matching each of its power pins (or None): the count and flag of
+    each group, and max. (n is set for each pin as it is placed.)
+    """
+    counts = Counter(rule.group for rule in rules if rule is not None)
+    values = {'': 1, 'n': 0}
+    for group in self.groups:
+      values[group] = counts[group]
+      values[group + '?'] = 1 if counts[group] else 0
+    values['max'] = max([evaluate_row(terms, values)
+                         for terms in self.max_rows] or [0])
+    return values
+
+def load_power_layout(file_name):
+  """
+  Load a PowerLayout from a JSON file, of the same structure as
+  power_layout_table. Raises OSError if it cannot be read, and TypeError
+  or ValueError if it is not of that structure.
+  """
+  import json
+  with open(file_name, encoding='utf-8') as f:
+    return PowerLayout(json.load(f))
+
+# The layout of the bundled EFM32 devices
+power_layout = PowerLayout(power_layout_table)
+
+########################################################################
+# UNIT PARTITIONING >
+#
+# Pins are assigned to units by a table: the GPIO ports of each unit in
+# turn, and which unit holds the power pins. Any unit (other than the
+# power unit, which is laid out by its PowerLayout) of more than
+# max_pins pins is split into consecutive parts of near equal size, each
+# a unit of its own - so the number of units of a component depends on
+# its pins. Units without pins keep their number.
+#
+# The table may be loaded from a JSON file of the same structure (see
+# load_unit_partition), eg for parts with ports PG to PK.
+
+unit_partition_table = {
+  'units': [['PA', 'PB'], ['PC', 'PD'], ['PE', 'PF'], 'power'],
+  # (None: never split)
+  'max_pins': None,
+}
+
+# Pattern matching the name of a power pin
+power_pin_re = re.compile(r'IOVD|A?VSS|A?VDD|RESE|DECO|USB_')
+
+class UnitPartition(object):
+  """
+  A table assigning pins to units - see unit_partition_table.
+  """
+
+  def __init__(self, table):
+    if not isinstance(table, dict) or 'units' not in table:
+      raise ValueError("Unit partition table without units")
+    if not isinstance(table['units'], list):
+      raise TypeError("Unit partition units are not a list")
+    self.table = table
+    self.unit_count = len(table['units'])
+
+    # Identifies the table, eg in the keys of pin_fields - where a copy
+    # of the partition (as sent to a worker process) is an object of its
+    # own
+    self.table_key = repr(table)
+    self.max_pins = table.get('max_pins')
+    if self.max_pins is not None and (not isinstance(self.max_pins, int)
+                                      or isinstance(self.max_pins, bool)):
+      raise TypeError("max_pins %r is not a whole number" % (self.max_pins,))
+    if self.max_pins is not None and self.max_pins < 1:
+      raise ValueError("max_pins must be 1 or more")
+
+    self.port_units = {}
+    self.power_unit = None
+    for number, ports in enumerate(table['units'], 1):
+      if ports == 'power':
+        if self.power_unit is not None:
+          raise ValueError("More than one power unit")
+        self.power_unit = number
+        continue
+      if not isinstance(ports, list) or \
+         not all(isinstance(port, str) for port in ports):
+        raise TypeError("Unit %d is not 'power' or a list of ports" %
+                        number)
+      for port in ports:
+        if port in self.port_units:
+          raise ValueError("Port %s is in more than one unit" % port)
+        self.port_units[port] = number
+    if self.power_unit is None:
+      raise ValueError("No power unit")
+
+    # The pattern matching a GPIO pin name, eg PA0 ... PF15
+    ports = sorted(self.port_units, key=len, reverse=True)
+    self.gpio_pin_re = re.compile(r'(%s)\d{1,2}$' % '|'.join(
+                                  [re.escape(port) for port in ports])
+                                  if ports else r'(?!)')
+
+  def unit(self, name):
+    """
+    Return the number of the unit (as in the table) of a pin name, or
+    None.
+    """
+    gpio_match = self.gpio_pin_re.search(name)
+    if gpio_match:
+      return self.port_units[gpio_match.group(1)]
+    if power_pin_re.match(name):
+      return self.power_unit
+    return None
+
+  def port(self, name):
+    """
+    Return the GPIO port of a pin name, or None.
+    """
+    gpio_match = self.gpio_pin_re.search(name)
+    return gpio_match.group(1) if gpio_match else None
+
+def load_unit_partition(file_name, max_pins=None):
+  """
+  Load a UnitPartition from a JSON file, of the same structure as
+  unit_partition_table - or, given no file, the default table. Either
+  way, max_pins (if given) replaces the table's. Raises OSError if the
+  file cannot be read, and TypeError or ValueError if it is not of that
+  structure.
+  """
+  if file_name is None:
+    table = dict(unit_partition_table)
+  else:
+    import json
+    with open(file_name, encoding='utf-8') as f:
+      table = json.load(f)
+  if max_pins is not None and isinstance(table, dict):
+    table['max_pins'] = max_pins
+  return UnitPartition(table)
+
+# The partitioning of the bundled EFM32 devices
+unit_partition = UnitPartition(unit_partition_table)
+
+########################################################################
+# COMPONENT MODEL >
+
+class Pin(object):
+  """
+  One pin of a component, as written to a KiCad 'X' line.
+  """
+  __slots__ = ('name', 'functionality', 'number', 'unit', 'elec_type',
+               'shape', 'x', 'y', 'length', 'orientation', 'name_size',
+               'number_size')
+
+  def __init__(self, name, functionality, number, unit, elec_type):
+    self.name = name
+    self.functionality = functionality # Alternate functions, if any
+    self.number = number
+    self.unit = unit
+    self.elec_type = elec_type # Elect.type: eg U, W, w or P
+    self.shape = '' # Graphic style, eg I=Inv.Pin
+    self.x = 0
+    self.y = 0
+    self.length = 0
+    self.orientation = 'R'
+    self.name_size = 50
+    self.number_size = 50
+
+  def label(self):
+    """
+    The pin name, followed by a "/" and its functionality, if any.
+    """
+    if self.functionality:
+      return self.name + '/' + self.functionality
+    return self.name
+
+  def kicad_line(self):
+    """
+    Format the pin as a KiCad 'X' line, eg:
+    X PA2/CMU_CLK0/TIM0_CC2_#0-1 3 0 -200 300 R 50 50 1 1 U
+    """
+    line = "X %s %s %d %d %d %s %d %d %d 1 %s" % (self.label(),
+            self.number, self.x, self.y, self.length, self.orientation,
+            self.name_size, self.number_size, self.unit, self.elec_type)
+    if self.shape:
+      line += ' ' + self.shape
+    return line + '\n'
+
+class Unit(object):
+  """
+  One unit of a multi unit component: its pins and box outline.
+  """
+  __slots__ = ('number', 'pins', 'power', 'blank_rows', 'x_min', 'y_max',
+               'x_max', 'y_min')
+
+  def __init__(self, number, pins, power=False):
+    self.number = number
+    self.pins = pins
+    self.power = power # The power unit, eg Unit 4
+    self.blank_rows = [] # Indices of the pins preceded by a blank row
+    self.x_min = 0
+    self.y_max = 0
+    self.x_max = 0
+    self.y_min = 0
+
+  def kicad_line(self):
+    """
+    Format the unit box outline as a KiCad 'S' line, eg:
+    S 300 150 3840 -2250 1 1 0 N
+    """
+    return "S %d %d %d %d %d 1 0 N\n" % (self.x_min, self.y_max,
+            self.x_max, self.y_min, self.number)
+
+class Component(object):
+  """
+  A multi unit component, with the device data from its CSV header.
+  Its unit count includes any units without pins - by default, it is
+  the highest unit number.
+  """
+  __slots__ = ('name', 'chip_name', 'package', 'pin_count',
+               'package_dims', 'units', 'unit_count', 'ref_pos',
+               'name_pos')
+
+  def __init__(self, name, chip_name, package, pin_count, package_dims,
+               units, unit_count=None):
+    self.name = name
+    self.chip_name = chip_name
+    self.package = package
+    self.pin_count = pin_count
+    self.package_dims = package_dims
+    self.units = units
+    if unit_count is None:
+      unit_count = max([unit.number for unit in units] or [0])
+    self.unit_count = unit_count
+    self.ref_pos = (0, 0) # Position of Unit reference, eg U1
+    self.name_pos = (0, 0) # Position of component name
+
+  def pins(self):
+    """
+    Generate all pins of the component, unit by unit.
+    """
+    for unit in self.units:
+      for pin in unit.pins:
+        yield pin
+
+########################################################################
+# TIDYING FUNCTIONS >
+
+# Abbreviate Pin Types to KiCAD pin type terminology
+# (partial kicad type listing - expand as required)
+pin_types = {'unknown': 'U',
+             'power':   'W', # 'W' is specifically POWER IN
+             'passive': 'P'}
+
+# USB_VREGO is specifically POWER OUT ('w') - only where its pin id is
+# a one or two digit number
+power_out_pin = 'USB_VREGO'
+power_out_id_re = re.compile(r'\d{1,2}$')
+
+# Any whitespace remaining after the SPACE and COMMA delimiters have
+# been replaced
+whitespace_re = re.compile(r'\s')
+
+def tidy_text(text):
+  """
+  Replace any SPACE and COMMA delimiters in a CSV field, eg:
+  'I2C0_SDA #0 / TIM0_CC0 #0,1' becomes 'I2C0_SDA_#0/TIM0_CC0_#0-1'
+  """
+  text = text.replace(' #', '_#')
+  text = text.replace(' / ', '/')
+  text = text.replace(',', '-')
+  return whitespace_re.sub('_', text)
+
+def column_indices(heading_row):
+  """
+  Return the positions of the 'Pin id', 'Pin name', 'Pin type' and
+  'Functionality' columns, given the CSV column heading row (None if
+  there is none). Raises DeviceFormatError if any is missing.
+  """
+  # (the "//" is optional, as for the header rows)
+  headings = [tidy_text(header_label_re.match(name).group(1))
+              for name in heading_row or []]
+  name2index = dict((k, v) for v, k in enumerate(headings))
+  missing = [k.replace('_', ' ') for k in device_column_headings
+             if k not in name2index]
+  if missing:
+    raise DeviceFormatError("Row %d: missing column heading(s) '%s'" %
+                            (device_header_rows + 1,
+                             "', '".join(missing)))
+  return [name2index[k] for k in device_column_headings]
+
+# The tidied fields of each pin seen so far - (unit, name, KiCad pin
+# type, functionality) - by its UnitPartition's table_key and raw 'Pin
+# name', 'Pin type' and 'Functionality' fields. The same pin functions
+# repeat from device to device across a family, so most pins are tidied
+# by a single lookup. Cleared once it reaches its size limit (0 for no
+# cache). Its hits and misses are counted in pin_fields_stats, and by
+# DeviceProfile.
+pin_fields = {}
+pin_fields_max = 20000
+pin_fields_stats = Counter()
+
+def tidy_pin_row(row, indices, partition=None):
+  """
+  Tidy one CSV pin row in a single pass, returning it as a Pin with its
+  unit number (by the UnitPartition - by default, unit_partition) and
+  KiCad pin type assigned. The fields other than the pin id are
+  memoised in pin_fields.
+  """
+  if partition is None:
+    partition = unit_partition
+
+  try:
+    pin_id, pin_name, pin_type, functionality = [row[i] for i in indices]
+  except IndexError:
+    raise DeviceFormatError("Pin %s: too few columns" % row[0])
+
+  key = (partition.table_key, pin_name, pin_type, functionality)
+  fields = pin_fields.get(key)
+  if fields is None:
+    pin_fields_stats['misses'] += 1
+
+    # Assign the unit number based on the pin name
+    unit = partition.unit(pin_name)
+    if unit is None:
+      raise DeviceFormatError("Pin %s: no unit for pin name '%s'" %
+                              (pin_id, pin_name))
+
+    pin_type = tidy_text(pin_type)
+    fields = (unit, tidy_text(pin_name),
+              pin_types.get(pin_type.lower(), pin_type),
+              tidy_text(functionality))
+    if pin_fields_max:
+      if len(pin_fields) >= pin_fields_max:
+        pin_fields.clear()
+      pin_fields[key] = fields
+  else:
+    pin_fields_stats['hits'] += 1
+
+  unit, pin_name, pin_type, functionality = fields
+  # (an alphanumeric pin id, eg 12 or A3, has nothing to tidy)
+  if not pin_id.isalnum():
+    pin_id = tidy_text(pin_id)
+  if pin_name == power_out_pin and pin_type == 'W' and \
+     power_out_id_re.match(pin_id):
+    pin_type = 'w'
+
+  return Pin(pin_name, functionality, pin_id, unit, pin_type)
+
 ########################################################################
 # SORTING FUNCTIONS >
 
 # Natural alphanumeric sort
 # From http://stackoverflow.com/questions/4836710/does-python-have-a-
 # built-in-function-for-string-natural-sort
+
+# Split text into its runs of digits, and the text between them
+digits_re = re.compile('([0-9]+)')
+
+# Natural sort keys of the texts seen so far - mostly pin names, which
+# repeat from device to device. Cleared once it reaches its size limit.
+natural_keys = {}
+natural_keys_max = 10000
+
+def natural_key(text):
+  """
+  Return the natural alphanumeric sort key of the text, eg:
+  'PA10' gives ('PA', 10, '') - which sorts after ('PA', 9, '')
+  """
+  try:
+    return natural_keys[text]
+  except KeyError:
+    pass
+  key = tuple([int(c) if c.isdigit() else c for c in digits_re.split(text)])
+  if len(natural_keys) >= natural_keys_max:
+    natural_keys.clear()
+  natural_keys[text] = key
+  return key
+
 def natural_sort(list, key=lambda s:s):
   """
   Sort the list into natural alphanumeric order.
   """
-  def get_alphanum_key_func(key):
-    convert = lambda text: int(text) if text.isdigit() else text
-    return lambda s: [convert(c) for c in re.split('([0-9]+)', key(s))]
-  sort_key = get_alphanum_key_func(key)
-  list.sort(key=sort_key)
+  list.sort(key=lambda s: natural_key(key(s)))
 
 # Sort table by multiple columns
 # Adapted from http://www.saltycrane.com/blog/2007/12/how-to-sort-table-
 # by-columns-in-python/
 def sort_table(table, cols):
   """ sort a table by multiple columns
-      table: a list of lists (or tuple of tuples) where each inner
-             list represents a row.
-      cols:  a list (or tuple) specifying the column numbers to sort
-             by. e.g. (1,0) would sort by column 1, then by column 0.
+      table: a list of objects (eg Pins) where each object represents
+             a row.
+      cols:  a list (or tuple) specifying the attribute names to sort
+             by. e.g. ('unit', 'name') would sort by unit, then by name.
+  A composite key of all the columns is computed once for each row, and
+  the table is sorted once.
   """
-  for col in reversed(cols):
-    natural_sort(table, key=lambda x: x[col])
+  table.sort(key=lambda x: tuple([natural_key(str(getattr(x, col)))
+                                  for col in cols]))
   return table
 
 ########################################################################
-########################################################################
-# PRIMARY DATA GENERATING FUNCTION
-#
-########################################################################
-# Stage 1
-# Get device description data: name, chip name, package and pin count
-# (Some of these values are as yet not utilised)
-
-
-def efm2kicad_generator(f_in):
-
-  global header_flag
+# INPUT FUNCTIONS >
 
-  script_file_name = sys.argv[0]
+def zip_members(zip_name, pattern):
+  """
+  Return the input sources for each member of the zip archive whose
+  name matches the glob 'pattern', in archive order.
+  """
+  import fnmatch, zipfile
+  with zipfile.ZipFile(zip_name) as archive:
+    return [(zip_name, member) for member in archive.namelist()
+            if fnmatch.fnmatch(member, pattern)]
 
-  # A few containers
-  csv_list_str = []
-  em_data_list = []
-  em_data1 = []
-  readnames = []
-  data = []
-  data1 = []
-  sorted_table = []
-  out_table = []
-  unit_boxes = []
-  final = []
-  final1 = []
-  final2 = []
+def open_device_file(f_in):
+  """
+  Open an input source for reading, in binary mode. The source is either
+  a CSV file name, or a (zip file name, member name) pair, in which case
+  the member is streamed directly from the archive without extracting
+  it.
+  """
+  if isinstance(f_in, tuple):
+    zip_name, member = f_in
+    return zip_archive(zip_name).open(member)
 
-  with open(f_in, 'rb') as f:
+  return open(f_in, 'rb')
 
-    if _debugflag == 1:
-      print "\n\nROW IN FILE"
+def zip_archive(zip_name):
+  """
+  Return the open ZipFile of an archive. Each archive is opened once per
+  process and kept open. (A worker process must not share its parent's
+  file position.)
+  """
+  key = (zip_name, os.getpid())
+  if key not in zip_archives:
+    import zipfile
+    zip_archives[key] = zipfile.ZipFile(zip_name)
+  return zip_archives[key]
 
-    # Read in the device CSV file
-    for row in csv.reader(f, delimiter=';'):
-      csv_list_str.append(row)
+def open_device_csv(f_in):
+  """
+  Open an input source (see open_device_file) for reading as text, ready
+  for device_rows.
+  """
+  import io
+  return io.TextIOWrapper(open_device_file(f_in), encoding='utf-8',
+                          newline='')
 
-      if _debugflag == 1:
-        print row
+########################################################################
+########################################################################
+# PRIMARY DATA GENERATING FUNCTIONS
+#
+########################################################################
+# Stage 1
+# Get device description data: name, chip name, package and pin count
+# (Some of these values are as yet not utilised)
+#
+# The header rows are checked against a schema as they are read, so a
+# malformed file is rejected before any of its pins are processed.
 
-  # Get part name from R2,C1
-  part_name_row = csv_list_str[2-1]
-  part_name = part_name_row[1]
-  # Get chip name from R3,C1
-  chip_name_row = csv_list_str[3-1]
-  chip_name = chip_name_row[1]
-  # Get package type from R4,C1
-  package_row = csv_list_str[4-1]
-  package = package_row[1]
-  # Get pin count from R6,C1
-  pin_cout_row = csv_list_str[6-1]
-  pin_count = pin_cout_row[1]
-  # Get package size from R7,C1
-  package_dims_row = csv_list_str[7-1]
-  package_dims = package_dims_row[1]
+class DeviceFormatError(ValueError):
+  """
+  A device CSV file not in the expected format - see
+  device_header_schema. The message names the row (or pin) at fault.
+  """
 
-  # Delete header rows ready for pin data extraction
-  del csv_list_str[0:8+1]
+def device_text(csv_data):
+  """
+  Return the contents of a device CSV file, given as bytes, as text.
+  Raises DeviceFormatError if it is not UTF-8.
+  """
+  try:
+    return csv_data.decode('utf-8')
+  except UnicodeDecodeError as e:
+    raise DeviceFormatError("Not UTF-8 text (%s)" % e.reason)
 
-  # Reassemble the data into a list of lists for the next stage
-  for row in csv_list_str:
-    em_data_list.append(';'.join(map(str, row)))
+def device_rows(f):
+  """
+  Read the rows of a device CSV file, given it open as text, one at a
+  time - as a csv.reader, but raising DeviceFormatError (rather than
+  UnicodeDecodeError or csv.Error) if it is not UTF-8 text, or not CSV.
+  """
+  rows = csv.reader(f, delimiter=';')
+  try:
+    for row in rows:
+      yield row
+  except UnicodeDecodeError as e:
+    raise DeviceFormatError("Not UTF-8 text (%s)" % e.reason)
+  except csv.Error as e:
+    raise DeviceFormatError("Row %d: %s" % (rows.line_num, e))
+
+# The number of header rows, which precede the column headings row
+device_header_rows = 9
+
+# For each header row read: its (1-based) number, the label of its first
+# cell (the "//" is optional), the field its second cell gives (None:
+# not used) and the pattern that value must match (None: any).
+device_header_schema = (
+  (2, 'Part name',          'part_name',    r'[^\s"]+$'),
+  (3, 'Chip name',          'chip_name',    r'\S'),
+  (4, 'Package',            'package',      r'[^\s"]+$'),
+  (5, 'Package type',       None,           None),
+  (6, 'Pin count',          'pin_count',    r'\d+$'),
+  (7, 'Package dimensions', 'package_dims', r'\S'),
+)
+
+# The column headings (as tidied) the pin rows must have, in the order
+# their values are read
+device_column_headings = ('Pin_id', 'Pin_name', 'Pin_type',
+                          'Functionality')
+
+header_label_re = re.compile(r'\s*(?://)?\s*(.*?)\s*$')
+
+# The schema, ready to check each row against
+device_header_checks = [(number, label, label.lower(), field,
+                         re.compile(pattern) if pattern else None)
+                        for number, label, field, pattern
+                        in device_header_schema]
+
+def read_device_header(rows):
+  """
+  Read the device description data from the header rows of a device
+  CSV file, given a csv.reader of the file. Returns it as a tuple:
+  (part name, chip name, package, pin count, package dimensions),
+  leaving the reader at the column headings row. Raises
+  DeviceFormatError if the header does not match device_header_schema.
+  """
 
-  if _debugflag == 1:
-    print "\n\nEM_DATA_LIST"
-    print em_data_list
+  # The header rows only (the pin rows are read by the next stage)
+  header_rows = list(islice(rows, device_header_rows))
+  if len(header_rows) < device_header_rows:
+    raise DeviceFormatError("Only %d rows, of a %d row header" %
+                            (len(header_rows), device_header_rows))
+
+  values = []
+  for number, label, label_key, field, value_re in device_header_checks:
+    row = header_rows[number - 1]
+    found = header_label_re.match(row[0]).group(1) if row else ''
+    if found.lower() != label_key:
+      raise DeviceFormatError("Row %d: expected '%s', found '%s'" %
+                              (number, label, found))
+    value = row[1] if len(row) > 1 else ''
+    if value_re is not None and not value_re.match(value):
+      raise DeviceFormatError("Row %d: invalid %s '%s'" %
+                              (number, label.lower(), value))
+    if field is not None:
+      values.append(value)
+
+  return tuple(values)
 
 ########################################################################
 # Stage 2
-# Tidy and format data using regex's
-
-  # perform some line by line regex editing
-  for line in em_data_list:
-    line = re.sub(r'//\s(?=\w)','', line )
-    # Insert Unit column header
-    line = re.sub(r'(Pin.name;)', '\\1Unit;' ,line)
-    # Insert Unit number based on Pin Names and append a "/" between
-    # pin Name and pin Functionality
-    line = re.sub(r'((PA|PB)\d{1,2});', '\\1/;1;' ,line)
-    line = re.sub(r'((PC|PD)\d{1,2});', '\\1/;2;' ,line)
-    line = re.sub(r'((PE|PF)\d{1,2});', '\\1/;3;' ,line)
-    line = re.sub(r'(^\w*\d{1,2};(IOVD.*?|A{0,1}VSS.*?|A{0,1}VDD.*?|RESE.*?|DECO.*?|USB_.*?));', '\\1;4;' ,line)
-    # Replace any SPACE and COMMA delimiters
-    line = re.sub(r' #','_#', line )
-    line = re.sub(r' / ','/', line )
-    line = re.sub(r',','-', line )
-    line = re.sub(r'\s','_', line ) # inserts underscores in headings
-    # Abbreviate Pin Types to KiCAD pin type terminology
-    # (partial kicad type listing - expand as required)
-    line = re.sub(r'(?i)unknown', 'U', line) # (?i) = Ignore case
-    line = re.sub(r'(?i)power', 'W', line) # 'W' is specifically POWER IN
-    line = re.sub(r'(^\d{1,2};USB_VREGO;4);W;', '\\1;w;', line) # 'w' is specifically POWER OUT
-    line = re.sub(r'(?i)passive', 'P', line)
-    em_data1.append(line)
-
-  # Reformat the data ready for reordering columns
-  # Split the regex'd lines at ";" and place them in another container
-
-  for line in em_data1:
-    readnames.append(line.split(';'))
-
-  if _debugflag == 1:
-    print "\n\nREADNAMES"
-    print readnames
-
-########################################################################
+# Tidy and format data
+#
 # Stage 3
 # Reorder columns
-# From http://stackoverflow.com/questions/6117868/...
-# ...write-csv-columns-out-in-a-different-order-in-python
 #
 # Original order:
 # "'// Pin id'  'Pin name'  'Pin type'  'Functionality'"
+#
+# Each pin row is tidied, assigned a unit number and made into a Pin in
+# a single pass (see tidy_pin_row).
 
+def tidy_pins(rows, profile=None, partition=None):
+  """
+  Return the Pins of a device, given its CSV rows - a csv.reader (or
+  list) of the rows which follow the header, starting with the column
+  headings. The rows are tidied as they are read, one at a time, and
+  assigned to units by the UnitPartition given, if any.
+  If a DeviceProfile is given, the pins processed, the CSV fields
+  rewritten ('substitutions') and the pin_fields hits and misses are
+  counted in it.
+  """
 
-  # The new order in which to arrange the columns
-  writenames = "Pin_name;Functionality;Pin_id;Unit;Pin_type".split(";")
+  # A container
+  pins = []
 
-  if _debugflag == 1:
-    print "\n\nWRITENAMES"
-    print writenames
+  rows = iter(rows)
+  indices = column_indices(next(rows, None))
 
-  # Create a dictionary using the column headings in the first row
-  name2index = dict((k, v) for v, k in enumerate(readnames[0]))
+  if profile is not None:
+    hits = pin_fields_stats['hits']
+    misses = pin_fields_stats['misses']
 
-  if _debugflag == 1:
-    print "\n\nNAMES TO INDEX"
-    print name2index
+  for row in rows:
+    # Skip any blank lines
+    if not row:
+      continue
+    pin = tidy_pin_row(row, indices, partition)
+    pins.append(pin)
 
-  # Create a list of the keys based on the existing column headings,
-  # and ordered according to the desired column order
-  writeindices = [name2index[k] for k in writenames]
+    if profile is not None:
+      tidied = (pin.number, pin.name, pin.elec_type, pin.functionality)
+      profile.counts['substitutions'] += \
+        sum(1 for i, text in zip(indices, tidied) if row[i] != text)
 
-  if _debugflag == 1:
-    print "\n\nWRITE INDICIES"
-    print writeindices
+  if profile is not None:
+    profile.counts['pins'] += len(pins)
+    profile.counts['pin_cache_hits'] += pin_fields_stats['hits'] - hits
+    profile.counts['pin_cache_misses'] += \
+      pin_fields_stats['misses'] - misses
 
-  if _debugflag == 1:
-    print "\n\nDATA ROW"
+  return pins
 
-  # Place the reordered columns in another container
-  for row in readnames:
-    data_row = [row[i] for i in writeindices]
-    data.append(data_row)
-    if _debugflag == 1:
-      print data_row
 ########################################################################
 # Stage 4A
 # Group the data into units and sort pin names within those units
 # using the natural alphanumeric sort function
 # From http://lists.ironpython.com/htdig.cgi/users-ironpython.com/...
 # 2009-January/009556.html
-#
+
+def partition_units(pins, partition=None):
+  """
+  Sort the Pins of a device by unit, then by name, and group them into
+  Units by the UnitPartition (by default, unit_partition) - splitting
+  any unit too large for it into parts. Returns the Units, and the unit
+  count of the component (including any units without pins).
+  """
+  if partition is None:
+    partition = unit_partition
+
+  # Sort the pins by Unit, then by pin name
+  sort_table(pins, ('unit', 'name'))
+
+  units = []
+  # The number of the last unit, after any splits, and of its unit in
+  # the partition table
+  number = 0
+  table_number = 0
+
+  for group_number, group in groupby(pins, lambda pin: pin.unit):
+    group = list(group)
+    power = group_number == partition.power_unit
+
+    # Units without pins keep their number
+    number += group_number - table_number - 1
+    table_number = group_number
+
+    max_pins = partition.max_pins
+    if power or max_pins is None or len(group) <= max_pins:
+      parts = [group]
+    else:
+      # Split into the fewest parts of near equal size
+      part_count = -(-len(group) // max_pins)
+      size = -(-len(group) // part_count)
+      parts = [group[i:i + size] for i in range(0, len(group), size)]
+
+    for part in parts:
+      number += 1
+      unit = Unit(number, part, power)
+      for pin in part:
+        pin.unit = number
+
+      # Within each unit insert a blank row between PXnn and PYnn
+      if not power:
+        ports = [partition.port(pin.name) for pin in part]
+        unit.blank_rows = [i for i in range(1, len(part))
+                           if ports[i] != ports[i - 1]]
+      units.append(unit)
+
+  return units, number + partition.unit_count - table_number
+
+########################################################################
 # Stage 4B
 # Insert pin (Y) position data
 #
-# Unique Power Unit (4) pin names to position in a predefined layout:
+# Unique Power Unit (4) pin names to position in a predefined layout
+# (by the rules of power_layout_table):
 # ['RESETn',
 # 'AVDD_0', 'AVDD_1', 'AVDD_2',
 # 'AVSS_0', 'AVSS_1', 'AVSS_2',
@@ -365,337 +1027,2242 @@ def efm2kicad_generator(f_in):
 # 'VDD_DREG',
 # 'VSS(1 to n)', 'VSS_DREG', 'VSS_PAD']
 
+def place_pins(units, layout=None):
+  """
+  Position the Pins of each Unit of a device - those of the power unit
+  by the rules of a PowerLayout (by default, power_layout), any matching
+  no rule following on the left, one per row, below the lowest placed.
+  Returns the number of pin rows in the power unit box.
+  """
+  if layout is None:
+    layout = power_layout
 
-  # Column location (within list) of the Units and pin_names values
-  unit_col = 3
-  pinname_col = 0
+  # LEFT side pin text orientation (note apparent reverse orientation!)
+  pin_left = 'R'
 
-  # Determine pin count within each sub-group of Unit 4 (power) pins
-  for row in data:
-    # If not a GPIO pin, copy the row to a new list
-    if not re.match(r'^P\w\d{1,2}', row[0]):
-      data1.append(row[0])
+  # LEFT side pin (X) position
+  pin_l_x = 0
 
-  # Delete the first (header) row in the new list
-  del data1[0]
+  # RIGHT side pin text orientation (note apparent reverse orientation!)
+  pin_right = 'L'
 
-  if _debugflag == 1:
-    print "\n\nDATA1"
-    print data1
+  # RIGHT side pin (X) position
+  pin_r_x = unit4_width + 2 * pin_length
 
-  # Count total instances of each GROUP of pin names
-  # eg AVDD_1, _2, _3 = AVDD : 3
-  # This compares names after triming the last char off each using:
-  count_dict_pin_name = Counter(row[0:5] for row in data1)
+  sides = {'left': (pin_l_x, pin_left), 'right': (pin_r_x, pin_right)}
 
-  # Extract the useful counts from above into vars
-  avdd_tot = count_dict_pin_name['AVDD_']
-  avss_tot = count_dict_pin_name['AVSS_']
-  iovdd_tot = count_dict_pin_name['IOVDD']
-  vss_tot = count_dict_pin_name['VSS']
-  vssdreg_flag = bool(count_dict_pin_name['VSS_D'])
-  usbv_flag = bool(count_dict_pin_name['USB_V'])
+  # The lowest row of a placed power pin determines box height
+  power_rows = 0
 
-  if _debugflag == 1:
-    print "\n\nCOUNT INSTANCES OF ASSOCIATED POWER PIN"
-    print count_dict_pin_name
+  for unit in units:
+    counter_row_in_unit = 0
+    blank_rows = set(unit.blank_rows)
 
-  # First get the headings
-  heading = data[0]
+    if unit.power:
+      # Classify each power pin by its placement rule, once, and count
+      # the pins of each group, eg AVDD_0, _1, _2 = AVDD : 3
+      rules = [layout.rule(pin.name) for pin in unit.pins]
+      values = layout.values(rules)
+      group_counters = Counter()
+    else:
+      rules = [None] * len(unit.pins)
 
-  # Delete the heading row - leaving data rows
-  del data[0]
+    for i, pin in enumerate(unit.pins):
 
-  # First unit number in a multi unit component
-  unit_number = 0
+      if i in blank_rows:
+        counter_row_in_unit += 1
 
-  # Unit 4 (only) has a fixed width
-  unit4_width = 1000
+      # GPIO units: pins ordered according to alphanumeric sort by name
+      pin.x = pin_l_x # Default pin X-pos
+      pin.y = -(pin_y_spacing * counter_row_in_unit) # Pin Y-pos
+      pin.length = pin_length
+      pin.orientation = pin_left # Default pin LEFT
+
+      # Power unit: pins placed by rule
+      rule = rules[i]
+      if rule is not None:
+        values['n'] = group_counters[rule.group]
+        group_counters[rule.group] += 1
+        row = evaluate_row(rule.row, values)
+        pin.x, pin.orientation = sides[rule.side]
+        pin.y = -(row * pin_y_spacing) # Pin Y-pos
+        if rule.rename:
+          pin.name = rule.rename
+        if rule.elec_type:
+          pin.elec_type = rule.elec_type
+        if rule.shape:
+          pin.shape = rule.shape
+        power_rows = max(power_rows, row)
+
+      counter_row_in_unit += 1
+
+    # Power pins of no rule, eg of another vendor's pin set: below the
+    # rest, so none overlap and all are in the box
+    if unit.power:
+      row = power_rows + 1 if any(rules) else 0
+      for pin, rule in zip(unit.pins, rules):
+        if rule is None:
+          pin.y = -(row * pin_y_spacing)
+          power_rows = row
+          row += 1
+
+  return power_rows
 
-  pin_length = 300
+########################################################################
+# Stage 5
+# Create (sub) unit box outlines
 
-  # LEFT side pin text orientation (note apparent reverse orientation!)
-  # and size: format = 'R pin_name_size pin_number_size'
-  pin_left_lts = (str(pin_length) + ' R 50 50')
-  #pin_left_txt_size = ' R 50 50'
-  #pin_left_lts = str(pin_length) + pin_left_txt_size
+def build_units(units, vss_max):
+  """
+  Set the box outline of each Unit of a device, once its Pins are
+  placed, and return the Units.
+  """
+  for unit in units:
+    unit.x_min = pin_length
+    unit.y_max = pin_y_box_offset
+
+    if not unit.power:
+      # (a blank row between ports shares the row below the last pin -
+      # any further blank rows add to the height)
+      unit.y_min = -(pin_y_spacing * (len(unit.pins) +
+                                      max(len(unit.blank_rows) - 1, 0))
+                     + pin_y_box_offset)
+      # (1 accounts for the "/" between pin name and functionality)
+      unit.x_max = (max([len(pin.name) + 1 + len(pin.functionality)
+                         for pin in unit.pins]) *
+                    45 + 300  + pin_length)
+    else:
+      # For the power unit
+      unit.y_min = -(vss_max * pin_y_spacing + pin_y_box_offset)
+      unit.x_max = unit4_width + pin_length
 
-  # LEFT side pin (X) position
-  pin_l_x = str(0)
+  return units
 
-  # RIGHT side pin text orientation (note apparent reverse orientation!)
-  # and size: format = 'L pin_name_size pin_number_size'
-  pin_right_lts = (str(pin_length) + ' L 50 50')
-  #pin_right_txt_size = ' L 50 50'
-  #pin_right_lts = str(pin_length) + pin_right_txt_size
+########################################################################
+# Stages 4B & 5, in bulk
+# For devices of many pins, the pin positions, text widths and unit box
+# outlines are computed for all pins at once, as NumPy arrays, rather
+# than pin by pin. The result is identical.
+
+# Devices of at least this many pins are laid out in bulk, where NumPy
+# is available (None: never). Below about 1200 pins, the overhead of
+# each NumPy call outweighs the time saved (see benchmark_energymicro.py
+# --layout).
+bulk_layout_pins = 1500
+
+def numpy_or_none():
+  """
+  Return the numpy module, or None if it is not installed.
+  """
+  try:
+    import numpy
+  except ImportError:
+    return None
+  return numpy
 
-  # RIGHT side pin (X) position
-  pin_r_x = str(unit4_width + 2 * pin_length)
-
-  # Location of first pin in each Unit group
-  pin_y_spacing = 100
-
-  # Y offset from top & bottom pins to top or bottom of Unit box outline
-  pin_y_box_offset = 150
-
-  # Collection of fixed-position pins, pin relative offset values, and
-  # pin orientation, length and text size in Unit 4 (power)
-  up1 = ['RESETn', 0,  pin_left_lts]
-  up2 = ['DECOUPLE', 0, pin_right_lts]
-  up3 = ['IOVDD_n', 6, pin_right_lts]
-  up4 = ['USB_VBUS', 4, pin_left_lts]
-  up5 = ['USB_VREGI', 6, pin_left_lts]
-  up6 = ['USB_VREGO', 7, pin_left_lts]
-  up7 = ['VDD_DREG', 2, pin_right_lts]
-  up8 = ['VSS_DREG',3, pin_right_lts]
-  up9 = ['VSS', 3, pin_right_lts]
-  up10 = ['AVDD', 4, pin_left_lts]
-  up11 = ['AVSS', 2, pin_left_lts]
+def place_pins_bulk(units, layout=None):
+  """
+  As place_pins, computing the positions of all pins at once.
+  """
+  import numpy
+  if layout is None:
+    layout = power_layout
+
+  pins = [pin for unit in units for pin in unit.pins]
+  count = len(pins)
+  sizes = numpy.array([len(unit.pins) for unit in units], numpy.int64)
+  starts = numpy.cumsum(sizes) - sizes
+
+  # Row of each pin: its place in its unit, plus the blank rows before
+  # it in its unit
+  blank = numpy.zeros(count, numpy.int64)
+  for unit, start in zip(units, starts.tolist()):
+    blank[[start + i for i in unit.blank_rows]] = 1
+  blanks = numpy.cumsum(blank)
+  unit_start = numpy.repeat(starts, sizes)
+  rows = numpy.arange(count) - unit_start + blanks - blanks[unit_start]
+
+  xs = numpy.zeros(count, numpy.int64)
+  ys = -(pin_y_spacing * rows)
+  right = numpy.zeros(count, bool)
+
+  # Power unit: pins placed by rule - each rule's pins a linear function
+  # of their place (n) in their group
+  rules = [None] * count
+  for unit, start in zip(units, starts.tolist()):
+    if unit.power:
+      rules[start:start + len(unit.pins)] = [layout.rule(pin.name)
+                                             for pin in unit.pins]
+  placed = [i for i, rule in enumerate(rules) if rule is not None]
+  power_rows = 0
+  if placed:
+    values = layout.values(rules)
+    placed = numpy.array(placed, numpy.int64)
+    groups = [rules[i].group for i in placed.tolist()]
+    group_ids = numpy.unique(groups, return_inverse=True)[1].ravel()
+    # n: pins of the same group placed before
+    order = numpy.argsort(group_ids, kind='stable')
+    first = numpy.flatnonzero(numpy.diff(group_ids[order], prepend=-1))
+    runs = numpy.repeat(first, numpy.diff(numpy.append(first,
+                                                       len(groups))))
+    n = numpy.empty(len(groups), numpy.int64)
+    n[order] = numpy.arange(len(groups)) - runs
+
+    # Each rule's row at n = 0, and its change with n
+    values['n'] = 0
+    rule_list = list(set(rules[i] for i in placed.tolist()))
+    rule_ids = dict((rule, k) for k, rule in enumerate(rule_list))
+    bases = numpy.array([evaluate_row(rule.row, values)
+                         for rule in rule_list], numpy.int64)
+    slopes = numpy.array([sum([m for m, value in rule.row if value == 'n'])
+                          for rule in rule_list], numpy.int64)
+    on_right = numpy.array([rule.side == 'right' for rule in rule_list])
+    pin_rules = numpy.array([rule_ids[rules[i]] for i in placed.tolist()],
+                            numpy.int64)
+    rule_rows = bases[pin_rules] + slopes[pin_rules] * n
+    right[placed] = on_right[pin_rules]
+
+    ys[placed] = -(rule_rows * pin_y_spacing)
+    xs[right] = unit4_width + 2 * pin_length
+    power_rows = int(rule_rows.max())
+
+  # Power pins of no rule: below the rest, as in place_pins
+  row = power_rows + 1 if len(placed) else 0
+  for unit, start in zip(units, starts.tolist()):
+    if unit.power:
+      for i in range(start, start + len(unit.pins)):
+        if rules[i] is None:
+          ys[i] = -(row * pin_y_spacing)
+          power_rows = row
+          row += 1
+
+  for pin, x, y, on_right, rule in zip(pins, xs.tolist(), ys.tolist(),
+                                       right.tolist(), rules):
+    pin.x = x
+    pin.y = y
+    pin.length = pin_length
+    # (note apparent reverse orientation!)
+    pin.orientation = 'L' if on_right else 'R'
+    if rule is not None:
+      if rule.rename:
+        pin.name = rule.rename
+      if rule.elec_type:
+        pin.elec_type = rule.elec_type
+      if rule.shape:
+        pin.shape = rule.shape
+
+  return power_rows
+
+def build_units_bulk(units, vss_max):
+  """
+  As build_units, computing the text widths and box outlines of all
+  units at once.
+  """
+  import numpy
+  pins = [pin for unit in units for pin in unit.pins]
+  # (1 accounts for the "/" between pin name and functionality)
+  widths = numpy.fromiter([len(pin.name) + 1 + len(pin.functionality)
+                           for pin in pins], numpy.int64, len(pins))
+
+  sizes = numpy.array([len(unit.pins) for unit in units], numpy.int64)
+  starts = numpy.cumsum(sizes) - sizes
+  x_maxes = numpy.maximum.reduceat(widths, starts) * 45 + 300 + pin_length
+  extra_rows = numpy.array([max(len(unit.blank_rows) - 1, 0)
+                            for unit in units], numpy.int64)
+  y_mins = -(pin_y_spacing * (sizes + extra_rows) + pin_y_box_offset)
+
+  for unit, x_max, y_min in zip(units, x_maxes.tolist(), y_mins.tolist()):
+    unit.x_min = pin_length
+    unit.y_max = pin_y_box_offset
+    if not unit.power:
+      unit.y_min = y_min
+      unit.x_max = x_max
+    else:
+      # For the power unit
+      unit.y_min = -(vss_max * pin_y_spacing + pin_y_box_offset)
+      unit.x_max = unit4_width + pin_length
+
+  return units
+
+########################################################################
+# Put it all together
+
+def component_from_rows(rows, profile=None, layout=None, partition=None):
+  """
+  Convert one device, given a csv.reader of its CSV data, returning its
+  Component. If a DeviceProfile is given, the time taken by each stage
+  is recorded in it. Its pins are assigned to units by the
+  UnitPartition given, if any (see partition_units), and the power unit
+  is placed by the PowerLayout given, if any (see place_pins).
+  """
+  # The CSV rows are streamed into Stage 2, rather than being read into
+  # a list first
+  if profile is None:
+    header = read_device_header(rows)
+    pins = tidy_pins(rows, None, partition)
+  else:
+    # ('tidy' includes reading the pin rows)
+    t = default_timer()
+    header = read_device_header(rows)
+    t = profile.lap('read', t)
+    pins = tidy_pins(rows, profile, partition)
+    t = profile.lap('tidy', t)
+
+  if bulk_layout_pins is not None and len(pins) >= bulk_layout_pins and \
+     numpy_or_none() is not None:
+    place, boxes = place_pins_bulk, build_units_bulk
+  else:
+    place, boxes = place_pins, build_units
+
+  # ('place' includes partitioning)
+  if profile is None:
+    units, unit_count = partition_units(pins, partition)
+    vss_max = place(units, layout)
+    boxes(units, vss_max)
+  else:
+    units, unit_count = partition_units(pins, partition)
+    vss_max = place(units, layout)
+    t = profile.lap('place', t)
+    boxes(units, vss_max)
+    t = profile.lap('boxes', t)
+
+  component = Component(*(header + (units, unit_count)))
 
   # Position of Unit reference, eg U1
-  ref_pos_x = 30 + pin_length
-  ref_pos_y = 30 + pin_y_box_offset
+  component.ref_pos = (30 + pin_length, 30 + pin_y_box_offset)
 
   # Position of PartUnit reference, eg U1
-  name_pos_x = 330 + pin_length
-  name_pos_y = 30 + pin_y_box_offset
-
-  if _debugflag == 1:
-    print "\n\nROW IN SORT_TABLE"
-
-  # Determine placement of AVDD_n (max) and IOVDD_n (max) by comparing
-  # existance of USB function with pin count of IOVDD and AVDD.
-  avdd_iovdd_comp = [0,0] # A compare container
-
-  # Max required (Y) position of AVDD_n(max)
-  avdd_iovdd_comp[0] = (usbv_flag * up6[1] + up10[1] + avdd_tot)
-
-  # Max required (Y) position of IOVDD_n(max)
-  avdd_iovdd_comp[1] = (iovdd_tot + up3[1])
-  avdd_iovdd_max = max(avdd_iovdd_comp)
-  #print avdd_comp # Debug
-  #print avdd_max # Debug
-
-  # Sort the data by Unit, then by pin name
-  for row in sort_table(data, (unit_col,pinname_col)):
-
-    if _debugflag == 1:
-      print row
-
-    # If the Unit number is not the same as that of the previous row,
-    # reset the counters
-    if int(row[unit_col]) != unit_number:
-      counter_row_in_unit = 0
-      unit_row_sub_flag = 0
-      unit_number += 1
-      iovdd_row_counter = 0
-      vss_row_counter = 0
-      avdd_row_counter = 0
-      avss_row_counter = 0
-
-    # Within each unit insert a blank row between PXnn and PYnn
-    if unit_row_sub_flag == 0:
-      if re.match(r'^PB|PD|PF\d{1,2}', row[pinname_col]):
-        unit_row_sub_flag = 1
-        counter_row_in_unit += 1
+  component.name_pos = (330 + pin_length, 30 + pin_y_box_offset)
 
-    # Insert the pin position data based on
-    # pin name order in each Unit group
-
-    # Unit 1 to 3: pins ordered according to alphanumeric sort by name
-    row.insert(0, 'X') # Kicad designator for a pin line = "X"
-    row.insert(-1, '1')
-    row.insert(-3, pin_l_x) # Default pin X-pos
-    row.insert(-3, str(-(pin_y_spacing * counter_row_in_unit))) # Pin Y-pos
-    row.insert(-3, pin_left_lts) # Default pin LEFT, length & text sizes
-
-    # Reset pin
-    if row[1] == up1[0]:
-      row[1] = '~RESET~' # double '~' displays vinculum over pin name
-      row[5] = str(-(up1[1] * pin_y_spacing))
-      row[6] = up1[2] # Pin length, direction and text size
-      row[9] = 'P I' # Elect.type: P=Passive, Graphic style: I=Inv.Pin
-
-    # Decouple
-    if row[1] == up2[0]:
-      row[4] = pin_r_x # Pin X-position
-      row[5] = str(-(up2[1] * pin_y_spacing)) # Pin Y-pos
-      row[6] = up2[2] # Pin length, direction and text size
-
-    # IOVDD_x
-    if re.match('IOVDD_\d', row[1]):
-      row[4] = pin_r_x # Pin X-position
-      row[5] = str(-(avdd_iovdd_max - iovdd_tot + iovdd_row_counter) * \
-                      pin_y_spacing) # Pin Y-pos
-      row[6] = up3[2] # Pin length, direction and text size
-      iovdd_row_counter += 1
-
-    # USB_VBUS
-    if row[1] == up4[0]:
-      row[4] = pin_l_x # Pin X-position
-      row[5] = str(-(up4[1] * pin_y_spacing)) # Pin Y-pos
-      row[6] = up4[2] # Pin length, direction and text size
-
-    # USB_VREGI
-    if row[1] == up5[0]:
-      row[4] = pin_l_x # Pin X-position
-      row[5] = str(-(up5[1] * pin_y_spacing)) # Pin Y-pos
-      row[6] = up5[2] # Pin length, direction and text size
-
-    # USB_VREGO
-    if row[1] == up6[0]:
-      row[4] = pin_l_x # Pin X-position
-      row[5] = str(-(up6[1] * pin_y_spacing)) # Pin Y-pos
-      row[6] = up6[2] # Pin length, direction and text size
-
-    # VDD_DREG
-    if row[1] == up7[0]:
-      row[4] = pin_r_x # Pin X-position
-      row[5] = str(-(avdd_iovdd_max - iovdd_tot - up7[1]) * \
-                      pin_y_spacing) # Pin Y-pos
-      row[6] = up7[2] # Pin length, direction and text size
-
-    # VSS_DREG
-    if row[1] == up8[0]:
-      vss_dreg_flag = 2
-      row[4] = pin_r_x # Pin X-position
-      row[5] = str(-(up8[1] + avdd_iovdd_max) * pin_y_spacing) # Pin Y-pos
-      #row[5] = str(-(up8[1] + iovdd_tot + 6) * pin_y_spacing) # Pin Y-pos
-      row[6] = up8[2] # Pin length, direction and text size
-
-    # VSS
-    if re.match('VSS(?!.D)', row[1]):
-      row[4] = pin_r_x # Pin X-position
-      row[5] = str(-(avdd_iovdd_max + up9[1] + (vssdreg_flag * 2) + \
-                      vss_row_counter) * pin_y_spacing) # Pin Y-pos
-      row[6] = up9[2] # Pin length, direction and text size
-      vss_row_counter += 1
-      # vss_max (vss or vss_pad) determines box height
-      vss_max = (avdd_iovdd_max + up9[1] + (vssdreg_flag * 2) + \
-                      vss_row_counter - 1)
-
-    # AVDD_n - v0.4
-    if re.match('AVDD_.', row[1]):
-      row[4] = pin_l_x # Pin X-position
-      row[5] = str(-(avdd_iovdd_max - avdd_tot + avdd_row_counter) * \
-                      pin_y_spacing) # Pin Y-pos
-      row[6] = up10[2] # Pin length, direction and text size
-      avdd_row_counter += 1
-
-    # AVSS_n
-    if re.match('AVSS_.', row[1]):
-      row[4] = pin_l_x # Pin X-position
-      row[5] = str(-(avdd_iovdd_max + up9[1] + (vssdreg_flag * 2) + \
-                      vss_tot + avss_row_counter - avss_tot) * \
-                      pin_y_spacing) # Pin Y-pos
-      row[6] = up11[2] # Pin length, direction and text size
-      avss_row_counter += 1
-
-    counter_row_in_unit += 1
-    sorted_table.append(row)
-
-  if _debugflag == 1:
-    print "\n\nvss_max, vssdreg_flag, avss_tot, \
-          avss_row_counter, iovdd_row_counter"
-    print vss_max, vssdreg_flag, avss_tot, \
-          avss_row_counter, iovdd_row_counter
+  return component
+
+def efm2kicad_component(f_in, profile=None, layout=None, partition=None):
+  """
+  Convert one device CSV file (or zip archive member - see
+  open_device_csv), returning its Component. For profile, layout and
+  partition, see component_from_rows.
+  """
+  with open_device_csv(f_in) as f:
+    return component_from_rows(device_rows(f), profile, layout,
+                               partition)
+
+def convert(csv_data, layout=None, partition=None):
+  """
+  Convert one device from its CSV data - the contents of a device CSV
+  file, as bytes (UTF-8) or text - returning its Component. For layout
+  and partition, see component_from_rows.
+  No files are read or written, and the only global state changed is
+  that of the module's memo caches - natural_keys and pin_fields (and,
+  when rendering symbols, sym_lengths and sym_effects_lists). Each is a
+  dict read and written by single operations, which the GIL makes safe,
+  so this may be called from any number of threads at once. Only the
+  pin_fields_stats counts may then be approximate, as their increments
+  are not atomic.
+  """
+  import io
+  if isinstance(csv_data, bytes):
+    csv_data = device_text(csv_data)
+  rows = device_rows(io.StringIO(csv_data, newline=''))
+  return component_from_rows(rows, None, layout, partition)
+
+def efm2kicad_convert(f_in, cache=None, profile=None, layout=None,
+                      partition=None, output_format='lib'):
+  """
+  Convert one device CSV file (or zip archive member - see
+  open_device_csv), returning its (LIB, DCM) text blocks - or, for
+  output_format 'kicad_sym', its (symbol, '') text blocks.
+  If a ComponentCache is given, an unchanged device's blocks are taken
+  from it instead of being generated again - the cache must be of the
+  same PowerLayout, UnitPartition and output format. For profile,
+  layout and partition, see component_from_rows.
+  """
+  if cache is not None:
+    t = default_timer()
+    key = cache.key(f_in)
+    output = cache.get(key)
+    if profile is not None:
+      profile.lap('cache', t)
+      profile.counts['cache_hits' if output else 'cache_misses'] += 1
+    if output is not None:
+      return output
+
+  component = efm2kicad_component(f_in, profile, layout, partition)
+  t = default_timer()
+  output = render_component(component, output_format)
+  if profile is not None:
+    profile.lap('render', t)
+
+  if cache is not None:
+    cache.put(key, output)
+  return output
+
+def efm2kicad_convert_profiled(f_in, cache=None, layout=None,
+                               partition=None, output_format='lib'):
+  """
+  As efm2kicad_convert, but returns a (LIB, DCM, DeviceProfile) tuple -
+  for use by worker processes.
+  """
+  profile = DeviceProfile(f_in)
+  output_lib, output_dcm = efm2kicad_convert(f_in, cache, profile, layout,
+                                             partition, output_format)
+  return output_lib, output_dcm, profile
 
 ########################################################################
-# Stage 5
-# Create (sub) unit box outlines
+# OUTPUT FUNCTIONS >
+
+def render_component(component, output_format='lib'):
+  """
+  Return the (LIB, DCM) text blocks of a component - or, for
+  output_format 'kicad_sym', its (symbol, '') text blocks.
+  """
+  if output_format == 'kicad_sym':
+    return render_sym_body(component), ''
+  return render_lib_body(component), render_dcm_body(component)
+
+def render_lib_body(component):
+  """
+  Return the LIB text block of a component: its unit box outlines
+  followed by its pins.
+  """
+  comp_pin_data = ''.join(chain((unit.kicad_line()
+                                 for unit in component.units),
+                                (pin.kicad_line()
+                                 for pin in component.pins())))
+
+  return template_lib_body.format(compname =      component.name,
+                                  unitcount =     component.unit_count,
+                                  footprint =     component.package,
+                                  refposx =       component.ref_pos[0],
+                                  refposy =       component.ref_pos[1],
+                                  nameposx =      component.name_pos[0],
+                                  nameposy =      component.name_pos[1],
+                                  comp_pin_data = comp_pin_data)
+
+def render_description(component):
+  """
+  Return the description of a component, eg its DCM 'D' line.
+  """
+  return template_description.format(chipname =  component.chip_name,
+                                     footprint = component.package,
+                                     fpsize =    component.package_dims)
+
+def render_dcm_body(component):
+  """
+  Return the DCM text block of a component.
+  """
+  return template_dcm_body.format(compname =    component.name,
+                                  description = render_description(
+                                                  component),
+                                  keywords =    component_keywords,
+                                  datasheet =   component_datasheet)
+
+# The epoch of reproducible output where SOURCE_DATE_EPOCH is not set,
+# in seconds since 1970-01-01 00:00:00 UTC
+reproducible_epoch = 0
+
+def source_date_time(reproducible=False):
+  """
+  Return the datetime to date the output by: that of the environment
+  variable SOURCE_DATE_EPOCH (seconds since 1970, UTC) if it is set -
+  see https://reproducible-builds.org/specs/source-date-epoch/ - or
+  else, if reproducible, reproducible_epoch. Otherwise, returns None
+  (now).
+  """
+  epoch = os.environ.get('SOURCE_DATE_EPOCH')
+  if epoch is None:
+    if not reproducible:
+      return None
+    epoch = reproducible_epoch
+  elif not epoch.isdigit():
+    raise ValueError("SOURCE_DATE_EPOCH must be a whole number of \
+seconds, not '%s'" % epoch)
+
+  import datetime
+  return datetime.datetime.fromtimestamp(int(epoch),
+                                         datetime.timezone.utc)
+
+def render_headers(date_time=None, generator=None):
+  """
+  Return the LIB and DCM file headers, dated date_time (a datetime -
+  by default, now) and naming the generator (by default, this script
+  as it was run).
+  """
+  if date_time is None:
+    import datetime
+    date_time = datetime.datetime.now()
+  # (not %X, which depends on the locale)
+  date_time_group = date_time.strftime("%Y-%m-%d %H:%M:%S")
+
+  if generator is None:
+    generator = sys.argv[0]
+
+  header_lib = template_lib_header.format(dtg =     date_time_group,
+                                          sfname =  generator,
+                                          filever = __version__)
+
+  header_dcm = template_dcm_header.format(dtg =     date_time_group,
+                                          sfname =  generator,
+                                          filever = __version__)
+
+  return header_lib, header_dcm
+
+def render_lib(components, alias=False, date_time=None, generator=None):
+  """
+  Return a complete LIB file of the Components, as text. With
+  alias=True, identical components are written as ALIASes (see
+  alias_lib_blocks). The header is dated date_time (by default, now)
+  and names the generator (by default, this module).
+  """
+  header_lib = render_headers(date_time, generator or __name__)[0]
+  output_libs = [render_lib_body(component) for component in components]
+  if alias:
+    output_libs = alias_lib_blocks(output_libs)
+  return header_lib + ''.join(output_libs) + template_lib_footer
+
+def render_dcm(components, date_time=None, generator=None):
+  """
+  Return a complete DCM file of the Components, as text, with its
+  header as for render_lib.
+  """
+  header_dcm = render_headers(date_time, generator or __name__)[1]
+  return header_dcm + ''.join([render_dcm_body(component)
+                               for component in components]) + \
+         template_dcm_footer
+
+# The lines of a LIB text block which carry the component name
+lib_name_re = re.compile(r'^(# |DEF |F1 ")[^\s"]+', re.M)
+
+def alias_fingerprint(output_lib):
+  """
+  Return the name of the component in a LIB text block, and the block
+  with its name removed. Electrically identical components - eg flash
+  size variants - have the same fingerprint.
+  """
+  name = re.search(r'^DEF ([^\s"]+)', output_lib, re.M).group(1)
+  return name, lib_name_re.sub(r'\1', output_lib)
+
+def alias_lib_blocks(output_libs):
+  """
+  Return the LIB text blocks, less those identical to an earlier block
+  other than in name - whose names are instead added to the ALIAS line
+  of the first such block.
+  """
+  # [output_lib, alias names], in order and indexed by fingerprint
+  lib_blocks = []
+  fingerprints = {}
+  for output_lib in output_libs:
+    name, fingerprint = alias_fingerprint(output_lib)
+    if fingerprint in fingerprints:
+      fingerprints[fingerprint][1].append(name)
+    else:
+      fingerprints[fingerprint] = [output_lib, []]
+      lib_blocks.append(fingerprints[fingerprint])
+
+  return [output_lib.replace('$FPLIST\n', 'ALIAS %s\n$FPLIST\n'
+                             % ' '.join(aliases), 1)
+          if aliases else output_lib
+          for output_lib, aliases in lib_blocks]
+
+class LibraryWriter(object):
+  """
+  Owns the LIB and DCM output files for a whole run. Both are written
+  through large buffers to temporary files alongside their destinations,
+  and only renamed into place by close() once complete - so a run which
+  fails part way through never leaves a half-written library behind.
+  Use as a context manager, or call close() (or abort() on failure).
+
+  With alias=True, a component identical to one already written (other
+  than in name) is not given a DEF block of its own, but is added to
+  the ALIAS line of the first. Every component keeps its DCM entry.
+
+  The headers are dated date_time and name the generator, as for
+  render_headers.
+  """
+
+  # Output buffer size, in bytes
+  buffer_size = 1024 * 1024
+
+  def __init__(self, lib_name, dcm_name, alias=False, date_time=None,
+               generator=None):
+    self.lib_name = lib_name
+    self.dcm_name = dcm_name
+    self.date_time = date_time
+    self.generator = generator
+    self.header_flag = 0
+    self.f_out_lib = open(lib_name + '.tmp', 'w', self.buffer_size,
+                          encoding='utf-8')
+    self.f_out_dcm = open(dcm_name + '.tmp', 'w', self.buffer_size,
+                          encoding='utf-8')
+
+    # With aliases, the LIB blocks are held until close()
+    self.alias = alias
+    self.lib_blocks = []
+
+  def write_component(self, output_lib, output_dcm):
+    """
+    Write one component's LIB and DCM text blocks, preceded by the file
+    headers if none have been written yet.
+    """
+    if self.header_flag == 0:
+      self.header_flag = 1
+
+      header_lib, header_dcm = render_headers(self.date_time,
+                                              self.generator)
+      self.f_out_lib.write(header_lib)
+      self.f_out_dcm.write(header_dcm)
+
+    if self.alias:
+      self.lib_blocks.append(output_lib)
+    else:
+      self.f_out_lib.write(output_lib)
+    self.f_out_dcm.write(output_dcm)
+
+  def close(self):
+    """
+    Write the file footers and move both files into place.
+    """
+    for output_lib in alias_lib_blocks(self.lib_blocks):
+      self.f_out_lib.write(output_lib)
+
+    self.f_out_lib.write(template_lib_footer)
+    self.f_out_dcm.write(template_dcm_footer)
+    self.f_out_lib.close()
+    self.f_out_dcm.close()
+
+    for name in (self.lib_name, self.dcm_name):
+      os.replace(name + '.tmp', name)
+
+  def abort(self):
+    """
+    Discard both temporary files, leaving any previous output intact.
+    """
+    self.f_out_lib.close()
+    self.f_out_dcm.close()
+    for name in (self.lib_name, self.dcm_name):
+      os.remove(name + '.tmp')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+def efm2kicad_generator(f_in, writer, cache=None, run_profile=None,
+                        layout=None, partition=None, output_format='lib',
+                        on_error=None):
+  """
+  Convert one device CSV file and write it with the LibraryWriter (or,
+  for output_format 'kicad_sym', SymbolLibraryWriter).
+  If a RunProfile is given, the device's DeviceProfile is added to it.
+  For layout and partition, see component_from_rows. If on_error is
+  given, a device not in the expected format is not written, but
+  on_error is called with f_in and its DeviceFormatError.
+  """
+  try:
+    if run_profile is None:
+      output = efm2kicad_convert(f_in, cache, None, layout, partition,
+                                 output_format)
+    else:
+      output = efm2kicad_convert_profiled(f_in, cache, layout, partition,
+                                          output_format)
+  except DeviceFormatError as e:
+    if on_error is None:
+      raise
+    on_error(f_in, e)
+    return
+
+  if run_profile is None:
+    writer.write_component(*output)
+  else:
+    run_profile.write_component(writer, *output)
+
+def convert_or_device_error(convert, f_in):
+  """
+  Return convert(f_in) - or the DeviceFormatError it raises, so a worker
+  process hands it back in place of the device's output.
+  """
+  try:
+    return convert(f_in)
+  except DeviceFormatError as e:
+    return e
+
+def efm2kicad_batch(f_in_list, jobs, writer, cache=None, run_profile=None,
+                    layout=None, partition=None, output_format='lib',
+                    on_error=None):
+  """
+  Convert a list of device CSV files in a pool of 'jobs' worker
+  processes. Each worker returns its LIB and DCM (or symbol) text
+  blocks, which are written here - in the order of 'f_in_list' - so the
+  output is identical to that of a serial run. For layout and
+  partition, see component_from_rows, and for on_error,
+  efm2kicad_generator.
+  """
+  import functools, multiprocessing
+  if run_profile is None:
+    convert_one = functools.partial(efm2kicad_convert, cache=cache,
+                                    layout=layout, partition=partition,
+                                    output_format=output_format)
+  else:
+    convert_one = functools.partial(efm2kicad_convert_profiled,
+                                    cache=cache, layout=layout,
+                                    partition=partition,
+                                    output_format=output_format)
+  if on_error is not None:
+    convert_one = functools.partial(convert_or_device_error, convert_one)
+
+  pool = multiprocessing.Pool(jobs)
+  try:
+    for f_in, output in zip(f_in_list, pool.imap(convert_one, f_in_list)):
+      if isinstance(output, DeviceFormatError):
+        on_error(f_in, output)
+      elif run_profile is None:
+        writer.write_component(*output)
+      else:
+        run_profile.write_component(writer, *output)
+  finally:
+    pool.close()
+    pool.join()
 
-  # Create a dictionary of pins per unit
-  count_dict = Counter(row[7] for row in data)
-  if _debugflag == 1:
-    print "\n\nCOUNT DICT"
-    print count_dict
+########################################################################
+# KICAD_SYM OUTPUT >
+#
+# The S-expression symbol library format of KiCad 6 and later. Each
+# component is a symbol holding its documentation as properties, and
+# one sub-symbol per unit, named <component>_<unit>_1, holding its box
+# outline and pins - so no DCM file is written. Lengths are converted
+# from mils to millimetres; both formats have Y up.
+
+# The file format version written - that of KiCad 6, read by all later
+# versions
+sym_version = '20211014'
+
+sym_lib_header = \
+  "(kicad_symbol_lib (version {version}) (generator {generator})\n"
+sym_lib_footer = ")\n"
+
+# KiCad pin types and shapes, by their LIB abbreviations
+sym_pin_types = {'I': 'input', 'O': 'output', 'B': 'bidirectional',
+                 'T': 'tri_state', 'P': 'passive', 'U': 'unspecified',
+                 'W': 'power_in', 'w': 'power_out', 'C': 'open_collector',
+                 'E': 'open_emitter', 'N': 'no_connect'}
+sym_pin_shapes = {'': 'line', 'I': 'inverted', 'C': 'clock',
+                  'CI': 'inverted_clock', 'L': 'input_low',
+                  'CL': 'clock_low', 'V': 'output_low',
+                  'F': 'edge_clock_high', 'X': 'non_logic'}
+
+# Pin angles, by LIB pin orientation (the direction the pin points)
+sym_pin_angles = {'R': '0', 'U': '90', 'L': '180', 'D': '270'}
+
+# Text size of the reference and name, in mils (as 'F0' and 'F1' of
+# template_lib_body), and the offset of pin names from the box (as DEF)
+sym_field_size = 60
+sym_pin_name_offset = 40
+
+# Formatted lengths, by length in mils - the same few dozen recur in
+# every component
+sym_lengths = {}
+
+def sym_mm(mils):
+  """
+  Format a length in mils as millimetres, as written in a .kicad_sym
+  file, eg 150 -> '3.81'.
+  """
+  try:
+    return sym_lengths[mils]
+  except KeyError:
+    text = ('%.4f' % (mils * 0.0254)).rstrip('0').rstrip('.')
+    if text == '-0':
+      text = '0'
+    sym_lengths[mils] = text
+    return text
+
+def sym_string(text):
+  """
+  Quote a string as an S-expression atom.
+  """
+  if '"' in text or '\\' in text:
+    text = text.replace('\\', '\\\\').replace('"', '\\"')
+  return '"' + text + '"'
+
+# A run of '~' in the legacy overbar notation of a LIB pin name
+legacy_overbar_re = re.compile(r'~~|~')
 
-  x_min = pin_length
-  y_max = pin_y_box_offset
+def sym_overbar(text):
+  """
+  Convert a pin name from the legacy overbar notation of a LIB file to
+  that of KiCad 6+, eg '~RESET~' becomes '~{RESET}': each single '~'
+  starts or ends an overbar (which a space also ends, as does the end of
+  the name), and '~~' is a '~'.
+  """
+  if '~' not in text:
+    return text
+
+  output = []
+  overbar = False
+  position = 0
+  for match in legacy_overbar_re.finditer(text):
+    run = text[position:match.start()]
+    if overbar and ' ' in run:
+      run = run.replace(' ', '} ', 1)
+      overbar = False
+    output.append(run)
+    if match.group() == '~~':
+      output.append('~')
+    else:
+      output.append('}' if overbar else '~{')
+      overbar = not overbar
+    position = match.end()
 
-  # Group by unit number
-  for unit, group in groupby(sorted_table, lambda x: x[7]):
+  run = text[position:]
+  if overbar:
+    run = run.replace(' ', '} ', 1) if ' ' in run else run + '}'
+  output.append(run)
+  return ''.join(output)
 
-    if int(unit) < 4:
-      # (2 * spacing accounts for blank row between PXnn and PYnn)
-      y_min = -(pin_y_spacing * int(count_dict[unit])
-                + pin_y_box_offset)
-      x_max = (max([len(row[1] + row[2]) for row in group]) *
-                45 + 300  + pin_length)
+# Formatted (effects ...) lists, by size, hide and justify
+sym_effects_lists = {}
+
+def sym_effects(size, hide=False, justify=None):
+  """
+  Return an (effects ...) list for text of the size given, in mils.
+  """
+  key = (size, hide, justify)
+  try:
+    return sym_effects_lists[key]
+  except KeyError:
+    pass
+  effects = '(effects (font (size %s %s))' % (sym_mm(size), sym_mm(size))
+  if justify:
+    effects += ' (justify %s)' % justify
+  if hide:
+    effects += ' hide'
+  sym_effects_lists[key] = effects + ')'
+  return sym_effects_lists[key]
+
+class SExpressionWriter(object):
+  """
+  Writes an S-expression to a text stream as it is built, laid out as
+  KiCad lays out its own files: each list begun with open() is on a line
+  of its own, indented by its depth, and lists added with leaf() follow
+  it on the same line. Nothing is held in memory but the open lists.
+  """
+
+  def __init__(self, f, depth=0):
+    self.write = f.write
+    self.depth = depth
+    # For each open list, whether any list has been opened within it
+    self.nested = []
+
+  def open(self, *atoms):
+    """
+    Begin a list of the atoms given, eg open('symbol', '"U1"').
+    """
+    if self.nested:
+      self.nested[-1] = True
+      self.write('\n')
+    self.write('  ' * (self.depth + len(self.nested)) + '(' +
+               ' '.join(atoms))
+    self.nested.append(False)
+
+  def leaf(self, *atoms):
+    """
+    Add a complete list of the atoms given to the open list, eg
+    leaf('at', '0', '0', '0').
+    """
+    self.write(' (' + ' '.join(atoms) + ')')
+
+  def close(self):
+    """
+    End the list last begun.
+    """
+    if self.nested.pop():
+      self.write('\n' + '  ' * (self.depth + len(self.nested)) + ')')
     else:
-      # For Unit 4 (power unit)
-      y_min = -(vss_max * pin_y_spacing + pin_y_box_offset)
-      x_max = unit4_width + pin_length
-    boxrow = "S %s %s %s %s %s 1 0 N" % (x_min,
-              y_max, x_max, y_min, unit)
-    unit_boxes.append(boxrow.split(','))
+      self.write(')')
+    if not self.nested:
+      self.write('\n')
+
+def write_sym_property(writer, number, key, value, position=(0, 0),
+                       effects=None):
+  """
+  Write one property of a symbol, hidden unless given its effects.
+  """
+  writer.open('property', sym_string(key), sym_string(value))
+  writer.leaf('id', str(number))
+  writer.leaf('at', sym_mm(position[0]), sym_mm(position[1]), '0')
+  writer.write(' ' + (effects or sym_effects(50, hide=True)))
+  writer.close()
+
+def write_sym_unit(writer, name, number, unit=None):
+  """
+  Write the sub-symbol of one unit of a component - an empty one if the
+  unit has no pins.
+  """
+  writer.open('symbol', sym_string('%s_%d_1' % (name, number)))
+  if unit is not None:
+    writer.open('rectangle')
+    writer.leaf('start', sym_mm(unit.x_min), sym_mm(unit.y_max))
+    writer.leaf('end', sym_mm(unit.x_max), sym_mm(unit.y_min))
+    writer.leaf('stroke (width 0) (type default) (color 0 0 0 0)')
+    writer.leaf('fill (type none)')
+    writer.close()
+
+    # (the lists within each pin are written in one go, as there are
+    # many pins)
+    for pin in unit.pins:
+      writer.open('pin', sym_pin_types[pin.elec_type],
+                  sym_pin_shapes[pin.shape])
+      writer.write(' (at %s %s %s) (length %s) (name %s %s) (number %s %s)'
+                   % (sym_mm(pin.x), sym_mm(pin.y),
+                      sym_pin_angles[pin.orientation], sym_mm(pin.length),
+                      sym_string(sym_overbar(pin.label())),
+                      sym_effects(pin.name_size),
+                      sym_string(pin.number),
+                      sym_effects(pin.number_size)))
+      writer.close()
+  writer.close()
+
+def render_sym_body(component):
+  """
+  Return the .kicad_sym text block of a component: its symbol, with its
+  documentation as properties and a sub-symbol per unit.
+  """
+  import io
+  f = io.StringIO()
+  writer = SExpressionWriter(f, 1)
+
+  writer.open('symbol', sym_string(component.name))
+  writer.leaf('pin_names (offset %s)' % sym_mm(sym_pin_name_offset))
+  writer.leaf('in_bom yes')
+  writer.leaf('on_board yes')
+
+  field_effects = sym_effects(sym_field_size, justify='left bottom')
+  write_sym_property(writer, 0, 'Reference', 'U', component.ref_pos,
+                     field_effects)
+  write_sym_property(writer, 1, 'Value', component.name,
+                     component.name_pos, field_effects)
+  write_sym_property(writer, 2, 'Footprint', '')
+  write_sym_property(writer, 3, 'Datasheet', component_datasheet)
+  write_sym_property(writer, 4, 'ki_keywords', component_keywords)
+  write_sym_property(writer, 5, 'ki_description',
+                     render_description(component))
+  write_sym_property(writer, 6, 'ki_fp_filters', component.package)
+
+  # One sub-symbol for every unit, including any without pins, so the
+  # unit count is kept
+  units = dict((unit.number, unit) for unit in component.units)
+  for number in range(1, component.unit_count + 1):
+    write_sym_unit(writer, component.name, number, units.get(number))
+
+  writer.close()
+  return f.getvalue()
+
+# The name of the symbol of a .kicad_sym text block, and the line of its
+# description - which differs between otherwise identical symbols
+sym_name_re = re.compile(r'^  \(symbol "([^"]+)"')
+sym_description_re = re.compile(r'^    \(property "ki_description".*\n',
+                                re.M)
+
+def sym_fingerprint(output_sym):
+  """
+  Return the name of the symbol in a .kicad_sym text block, and the block
+  with its name and description removed. Electrically identical
+  components - eg flash size variants - have the same fingerprint.
+  """
+  name = sym_name_re.match(output_sym).group(1)
+  fingerprint = sym_description_re.sub('', output_sym)
+  return name, fingerprint.replace(sym_string(name)[:-1], '"')
+
+def alias_sym_block(output_sym, parents):
+  """
+  Return a .kicad_sym text block - or, if an earlier block identical to
+  it other than in name is in parents (a dictionary of fingerprint:
+  name, which is updated), a derived symbol which extends that block's
+  symbol with its own name and properties. The KiCad equivalent of
+  alias_lib_blocks.
+  """
+  name, fingerprint = sym_fingerprint(output_sym)
+  parent = parents.setdefault(fingerprint, name)
+  if parent == name:
+    return output_sym
+
+  properties = [line for line in output_sym.splitlines(True)
+                if line.startswith('    (property ')]
+  return ''.join(['  (symbol %s (extends %s)\n' % (sym_string(name),
+                                                   sym_string(parent))] +
+                 properties + ['  )\n'])
+
+def render_sym_header(generator=None):
+  """
+  Return the head of a .kicad_sym file, naming the generator (by
+  default, this module). Unlike the LIB header, it carries no date.
+  """
+  generator = os.path.splitext(os.path.basename(generator or __name__))[0]
+  return sym_lib_header.format(version = sym_version,
+                               generator = re.sub(r'\W', '_', generator))
+
+def render_sym(components, alias=False, generator=None):
+  """
+  Return a complete .kicad_sym file of the Components, as text. With
+  alias=True, identical components are written as derived symbols (see
+  alias_sym_block).
+  """
+  output_syms = [render_sym_body(component) for component in components]
+  if alias:
+    parents = {}
+    output_syms = [alias_sym_block(output_sym, parents)
+                   for output_sym in output_syms]
+  return render_sym_header(generator) + ''.join(output_syms) + \
+         sym_lib_footer
+
+class SymbolLibraryWriter(object):
+  """
+  As LibraryWriter, but owns a single .kicad_sym output file, to which
+  each symbol is written as it is given. The DCM text blocks given are
+  not used, as the documentation is held in the symbols' properties.
+
+  With alias=True, a component identical to one already written (other
+  than in name) is written as a symbol derived from the first. The
+  header names the generator (by default, this script as it was run).
+  """
+
+  buffer_size = LibraryWriter.buffer_size
+
+  def __init__(self, sym_name, alias=False, generator=None):
+    self.sym_name = sym_name
+    self.f_out_sym = open(sym_name + '.tmp', 'w', self.buffer_size,
+                          encoding='utf-8')
+    self.f_out_sym.write(render_sym_header(generator or sys.argv[0]))
+
+    # Fingerprint: name of each symbol written, with aliases
+    self.parents = {} if alias else None
+
+  def write_component(self, output_sym, output_dcm=None):
+    """
+    Write one component's symbol text block.
+    """
+    if self.parents is not None:
+      output_sym = alias_sym_block(output_sym, self.parents)
+    self.f_out_sym.write(output_sym)
+
+  def close(self):
+    """
+    Write the file footer and move the file into place.
+    """
+    self.f_out_sym.write(sym_lib_footer)
+    self.f_out_sym.close()
+    os.replace(self.sym_name + '.tmp', self.sym_name)
+
+  def abort(self):
+    """
+    Discard the temporary file, leaving any previous output intact.
+    """
+    self.f_out_sym.close()
+    os.remove(self.sym_name + '.tmp')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+########################################################################
+# INGEST >
+#
+# Converts the devices of several sources - directories, zip archives
+# and CSV files - at once. The sources are listed, and the CSV data of
+# each device read, in threads, while the devices already read are
+# converted in a thread or process executor. At most 'in_flight'
+# devices are read or converted ahead of the writer, which writes them
+# in order - so I/O waits overlap with conversion, without the whole
+# input being held in memory.
+
+def discover_inputs(source, pattern='*.csv'):
+  """
+  Return the input sources (see open_device_file) of a source: each CSV
+  file of a directory, each member of a zip archive whose name matches
+  the glob 'pattern', or a CSV file itself.
+  """
+  if os.path.isdir(source):
+    return [os.path.join(source, filename)
+            for filename in os.listdir(source)
+            if filename.endswith(".csv")]
+  if source.endswith(".zip"):
+    f_in_list = zip_members(source, pattern)
+    # (opened here, once, for the reads of its members to share)
+    zip_archive(source)
+    return f_in_list
+  return [source]
+
+def read_device_data(f_in):
+  """
+  Return the contents of an input source, as bytes.
+  """
+  with open_device_file(f_in) as f:
+    return f.read()
+
+def efm2kicad_convert_data(csv_data, cache=None, profile=None, layout=None,
+                           partition=None, output_format='lib'):
+  """
+  As efm2kicad_convert, but given the contents of a device CSV file, as
+  bytes, rather than its name.
+  """
+  if cache is not None:
+    t = default_timer()
+    key = cache.key_data(csv_data)
+    output = cache.get(key)
+    if profile is not None:
+      profile.lap('cache', t)
+      profile.counts['cache_hits' if output else 'cache_misses'] += 1
+    if output is not None:
+      return output
+
+  import io
+  rows = device_rows(io.StringIO(device_text(csv_data), newline=''))
+  component = component_from_rows(rows, profile, layout, partition)
+  t = default_timer()
+  output = render_component(component, output_format)
+  if profile is not None:
+    profile.lap('render', t)
+
+  if cache is not None:
+    cache.put(key, output)
+  return output
+
+def efm2kicad_convert_data_profiled(f_in, csv_data, cache=None,
+                                    layout=None, partition=None,
+                                    output_format='lib'):
+  """
+  As efm2kicad_convert_data, but returns a (LIB, DCM, DeviceProfile)
+  tuple, the profile being of input source f_in.
+  """
+  profile = DeviceProfile(f_in)
+  output_lib, output_dcm = efm2kicad_convert_data(csv_data, cache, profile,
+                                                  layout, partition,
+                                                  output_format)
+  return output_lib, output_dcm, profile
+
+def device_file_name(f_in):
+  """
+  Return the file name of an input source, less any directory.
+  """
+  if isinstance(f_in, tuple):
+    f_in = f_in[1]
+  return os.path.basename(f_in.replace('\\', '/'))
+
+async def efm2kicad_ingest_async(sources, writer, executor, pattern='*.csv',
+                                 in_flight=32, cache=None, run_profile=None,
+                                 layout=None, partition=None,
+                                 output_format='lib', sort=False,
+                                 callback=None, on_error=None):
+  """
+  Convert every device of the sources (see discover_inputs), in the
+  executor, and write them with the writer - in the order of the
+  sources, and of each source's listing (sorted, if sort). Where
+  sources hold CSV files of the same name, only the first is converted.
+  Returns the input sources found. If a RunProfile is given, each
+  device's DeviceProfile is added to it; the callback, if any, is
+  called with each input source as it is written. For on_error, see
+  efm2kicad_generator.
+  """
+  import asyncio, functools
+  loop = asyncio.get_running_loop()
+
+  # List all of the sources at once
+  listings = await asyncio.gather(*[
+               loop.run_in_executor(None, discover_inputs, source, pattern)
+               for source in sources])
+
+  f_in_list = []
+  file_names = set()
+  for listing in listings:
+    for f_in in (sorted(listing) if sort else listing):
+      if device_file_name(f_in) not in file_names:
+        file_names.add(device_file_name(f_in))
+        f_in_list.append(f_in)
+
+  async def convert_one(f_in):
+    # Read in a thread, then convert in the executor
+    csv_data = await loop.run_in_executor(None, read_device_data, f_in)
+    if run_profile is None:
+      convert = functools.partial(efm2kicad_convert_data, csv_data,
+                                  cache, None, layout, partition,
+                                  output_format)
+    else:
+      convert = functools.partial(efm2kicad_convert_data_profiled, f_in,
+                                  csv_data, cache, layout, partition,
+                                  output_format)
+    return await loop.run_in_executor(executor, convert)
+
+  # The devices in flight, in order. Queuing blocks once it is full, so
+  # reading runs no further ahead of writing.
+  queue = asyncio.Queue(in_flight)
+
+  async def read_ahead():
+    for f_in in f_in_list:
+      await queue.put((f_in, asyncio.ensure_future(convert_one(f_in))))
+    await queue.put((None, None))
+
+  reader = asyncio.ensure_future(read_ahead())
+  try:
+    while True:
+      f_in, conversion = await queue.get()
+      if conversion is None:
+        break
+      try:
+        output = await conversion
+      except DeviceFormatError as e:
+        if on_error is None:
+          raise
+        on_error(f_in, e)
+        continue
+      if run_profile is None:
+        writer.write_component(*output)
+      else:
+        run_profile.write_component(writer, *output)
+      if callback is not None:
+        callback(f_in)
+    await reader
+
+  finally:
+    # On failure, abandon the devices still in flight
+    reader.cancel()
+    while not queue.empty():
+      conversion = queue.get_nowait()[1]
+      if conversion is not None:
+        conversion.cancel()
+
+  return f_in_list
+
+def efm2kicad_ingest(sources, writer, jobs=1, pattern='*.csv', in_flight=32,
+                     cache=None, run_profile=None, layout=None,
+                     partition=None, output_format='lib', sort=False,
+                     callback=None, on_error=None):
+  """
+  Convert every device of the sources, and write them with the writer,
+  as efm2kicad_ingest_async - converting in a pool of 'jobs' worker
+  processes, or (for 1) in a single thread alongside the reads. Returns
+  the input sources found.
+  """
+  import asyncio, concurrent.futures
+  if jobs > 1:
+    executor = concurrent.futures.ProcessPoolExecutor(jobs)
+  else:
+    executor = concurrent.futures.ThreadPoolExecutor(1)
+  with executor:
+    return asyncio.run(efm2kicad_ingest_async(sources, writer, executor,
+                                              pattern, in_flight, cache,
+                                              run_profile, layout,
+                                              partition, output_format,
+                                              sort, callback, on_error))
+
+########################################################################
+# INDEX >
+
+# The text block of each component in a LIB or DCM file, as bytes (see
+# render_lib_body and render_dcm_body). Allows for Windows line endings.
+lib_block_bytes_re = re.compile(
+  br'^# ([^\s"]+)\r?\n#\r?\nDEF \1 .*?^ENDDEF\r?\n#\r?\n', re.M | re.S)
+dcm_block_bytes_re = re.compile(
+  br'^\$CMP ([^\s"]+)\r?\n.*?^\$ENDCMP\r?\n#\r?\n', re.M | re.S)
+alias_line_bytes_re = re.compile(br'^ALIAS ([^\r\n]*)', re.M)
+
+def index_name(lib_name):
+  """
+  Return the name of the sidecar index of a LIB file, eg
+  energymicro-efm32.idx for energymicro-efm32.lib.
+  """
+  return os.path.splitext(lib_name)[0] + '.idx'
+
+def index_file(name, block_re):
+  """
+  Return the index of a LIB or DCM file: its size and modification time,
+  and the (byte offset, length) of the text block of each component.
+  A LIB file's ALIAS names are indexed to the block they appear in.
+  """
+  import mmap
+  blocks = {}
+  stat = os.stat(name)
+  with open(name, 'rb') as f:
+    if stat.st_size:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        for match in block_re.finditer(data):
+          block = (match.start(), match.end() - match.start())
+          blocks[match.group(1).decode('utf-8')] = block
+          alias_line = alias_line_bytes_re.search(data, match.start(),
+                                                  match.end())
+          if block_re is lib_block_bytes_re and alias_line is not None:
+            for alias in alias_line.group(1).decode('utf-8').split():
+              blocks[alias] = block
+      finally:
+        data.close()
+  return {'file': os.path.basename(name),
+          'size': stat.st_size,
+          'mtime_ns': stat.st_mtime_ns,
+          'components': blocks}
+
+def write_index(lib_name, dcm_name):
+  """
+  Write the sidecar index of a LIB and DCM file (see index_name), mapping
+  each component name to the byte offset and length of its text block
+  in each file - for LibraryIndex.
+  """
+  import json
+  index = {'version': __version__,
+           'lib': index_file(lib_name, lib_block_bytes_re),
+           'dcm': index_file(dcm_name, dcm_block_bytes_re)}
+  name = index_name(lib_name)
+  with open(name + '.tmp', 'w', encoding='utf-8') as f:
+    json.dump(index, f, sort_keys=True)
+  os.replace(name + '.tmp', name)
+
+class LibraryIndex(object):
+  """
+  Random access to the components of a LIB and DCM file through their
+  sidecar index (see write_index). The files are memory mapped, and a
+  component's text block is read without reading the rest of the file.
+  If the index is missing, or either file has changed since it was
+  written, the files are indexed again (but the sidecar is not
+  rewritten). Use as a context manager, or call close().
+  """
 
-  # Put it all together
-  for row in unit_boxes:
-    final.append(';'.join(map(str, row)))
+  def __init__(self, lib_name, dcm_name=None):
+    import json
+    if dcm_name is None:
+      dcm_name = os.path.splitext(lib_name)[0] + '.dcm'
+    self.lib_name = lib_name
+    self.dcm_name = dcm_name
+
+    try:
+      with open(index_name(lib_name), encoding='utf-8') as f:
+        index = json.load(f)
+    except (OSError, ValueError):
+      index = None
+    if index is None or not self.current(index):
+      index = {'lib': index_file(lib_name, lib_block_bytes_re),
+               'dcm': index_file(dcm_name, dcm_block_bytes_re)}
+    self.lib_blocks = index['lib']['components']
+    self.dcm_blocks = index['dcm']['components']
+
+    self.maps = {}
+
+  def current(self, index):
+    """
+    Return whether the index is of the LIB and DCM files as they are.
+    """
+    for name, key in ((self.lib_name, 'lib'), (self.dcm_name, 'dcm')):
+      try:
+        stat = os.stat(name)
+      except OSError:
+        return False
+      if key not in index or \
+         (index[key]['size'], index[key]['mtime_ns']) != \
+         (stat.st_size, stat.st_mtime_ns):
+        return False
+    return True
+
+  def __contains__(self, name):
+    return name in self.lib_blocks
+
+  def names(self):
+    """
+    Return the names of all components (and aliases) in the LIB file.
+    """
+    return sorted(self.lib_blocks)
+
+  def read_block(self, name, block):
+    """
+    Return the text of the block at (offset, length) in the named file.
+    """
+    import mmap
+    if name not in self.maps:
+      with open(name, 'rb') as f:
+        self.maps[name] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    offset, length = block
+    return self.maps[name][offset:offset + length].decode('utf-8')
+
+  def lib_block(self, name):
+    """
+    Return the LIB text block of the named component (or alias), or
+    None if there is no such component.
+    """
+    if name not in self.lib_blocks:
+      return None
+    return self.read_block(self.lib_name, self.lib_blocks[name])
+
+  def dcm_block(self, name):
+    """
+    Return the DCM text block of the named component, or None.
+    """
+    if name not in self.dcm_blocks:
+      return None
+    return self.read_block(self.dcm_name, self.dcm_blocks[name])
+
+  def close(self):
+    for data in self.maps.values():
+      data.close()
+    self.maps = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
 
-  for row in sorted_table:
-    final.append(';'.join(map(str, row)))
+########################################################################
+# SHARDING >
+#
+# Splits the library into several, by a field of the devices' CSV
+# headers - eg one library per chip family, or per package - so KiCad
+# need only load the libraries in use. Each shard is written by a
+# worker process of its own, and merge_libraries combines shards back
+# into a single library.
 
-  if _debugflag == 1:
-    print "\n\nFINAL"
-    print final
+# The CSV header fields a library may be sharded by, and their index in
+# the header (see read_device_header)
+shard_fields = {'chip_name': 1, 'package': 2}
 
-  # Strip out the last remaining delimiters
-  for line in final:
-    line = re.sub(r'/;','/', line ) # Between pin name and function
-    line = re.sub(r';;',' ', line ) # As occurs in Unit 4
-    line = re.sub(r';',' ', line )
-    line = re.sub(r'/ ',' ', line ) # As occurs when pin is GPIO only
-    line += "\n"
-    final1.append(line)
+def shard_key(value):
+  """
+  Return the shard key of a header field value, as used in file names:
+  eg 'leopard-gecko' for 'Leopard Gecko'.
+  """
+  return re.sub(r'[^a-z0-9]+', '-', value.lower()).strip('-') or 'other'
 
-  final2 = ''.join(str(n) for n in final1)
+def shard_file_names(lib_name, key, output_format='lib'):
+  """
+  Return the output file names of a shard, named after the library and
+  the shard key: eg energymicro-efm32-leopard-gecko.lib and .dcm - or,
+  for output_format 'kicad_sym', the .kicad_sym file alone.
+  """
+  base = '%s-%s' % (os.path.splitext(lib_name)[0], key)
+  if output_format == 'kicad_sym':
+    return [base + '.kicad_sym']
+  return [base + '.lib', base + '.dcm']
 
-  if _debugflag == 1:
-    print "\n\nFINAL 2"
-    print final2
+def shard_inputs(f_in_list, shard_by, on_error=None):
+  """
+  Group input sources (see open_device_file) by a field of their CSV
+  headers - 'chip_name' or 'package' (see shard_fields). Returns a list
+  of (shard key, [f_in, ...]) pairs, in order of each shard's first
+  device. For on_error, see efm2kicad_generator.
+  """
+  field = shard_fields[shard_by]
+  shards = {}
+  for f_in in f_in_list:
+    try:
+      with open_device_csv(f_in) as f:
+        header = read_device_header(device_rows(f))
+    except DeviceFormatError as e:
+      if on_error is None:
+        raise
+      on_error(f_in, e)
+      continue
+    shards.setdefault(shard_key(header[field]), []).append(f_in)
+  return list(shards.items())
+
+def efm2kicad_shard(shard, lib_name, cache=None, layout=None,
+                    partition=None, output_format='lib', alias=False,
+                    date_time=None, generator=None, skip=False):
+  """
+  Convert the devices of one shard - a (shard key, [f_in, ...]) pair of
+  shard_inputs - in turn, writing them to a library of their own (see
+  shard_file_names). Returns the file names written, and the (f_in,
+  DeviceFormatError) of each device not in the expected format - which,
+  unless skip, is raised instead.
+  """
+  key, f_in_list = shard
+  names = shard_file_names(lib_name, key, output_format)
+  if output_format == 'kicad_sym':
+    writer = SymbolLibraryWriter(names[0], alias, generator)
+  else:
+    writer = LibraryWriter(names[0], names[1], alias, date_time,
+                           generator)
 
-  now = datetime.datetime.now()
-  date_time_group = now.strftime("%Y-%m-%d %X")
+  skipped = []
+  if skip:
+    on_error = lambda f_in, e: skipped.append((f_in, e))
+  else:
+    on_error = None
+
+  with writer:
+    for f_in in f_in_list:
+      efm2kicad_generator(f_in, writer, cache, None, layout, partition,
+                          output_format, on_error)
+  return names, skipped
 
-  # Open output file for appending data
-  f_out_lib = open(fdest_lib, 'a')
-  f_out_dcm = open(fdest_dcm, 'a')
+def efm2kicad_shards(shards, lib_name, jobs=1, cache=None, layout=None,
+                     partition=None, output_format='lib', alias=False,
+                     date_time=None, generator=None, on_error=None):
+  """
+  Write a library for each shard of shard_inputs (see efm2kicad_shard),
+  in a pool of 'jobs' worker processes - one shard to each at a time.
+  Returns the file names written, shard by shard. For on_error, see
+  efm2kicad_generator.
+  """
+  import functools
+  write_shard = functools.partial(efm2kicad_shard, lib_name=lib_name,
+                                  cache=cache, layout=layout,
+                                  partition=partition,
+                                  output_format=output_format, alias=alias,
+                                  date_time=date_time, generator=generator,
+                                  skip=on_error is not None)
+  if jobs > 1 and len(shards) > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs, len(shards)))
+    results = pool.imap(write_shard, shards)
+  else:
+    pool = None
+    results = map(write_shard, shards)
+
+  shard_names = []
+  try:
+    for names, skipped in results:
+      shard_names.append(names)
+      for f_in, e in skipped:
+        on_error(f_in, e)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  return shard_names
+
+# The ALIAS line of a LIB text block
+alias_line_re = re.compile(r'^ALIAS [^\n]*\n', re.M)
+
+def rename_lib_block(output_lib, name, aliases):
+  """
+  Return a LIB text block with its component renamed, and its ALIAS line
+  listing the aliases given - or none, if there are none.
+  """
+  output_lib = lib_name_re.sub(lambda match: match.group(1) + name,
+                               output_lib)
+  output_lib = alias_line_re.sub('', output_lib)
+  if aliases:
+    output_lib = output_lib.replace('$FPLIST\n', 'ALIAS %s\n$FPLIST\n'
+                                    % ' '.join(aliases), 1)
+  return output_lib
+
+def merge_libraries(lib_names, lib_name, dcm_name, date_time=None,
+                    generator=None):
+  """
+  Merge LIB files, each with the DCM file of the same name alongside it,
+  into one LIB and DCM file - eg the shards of efm2kicad_shards. The
+  text blocks are copied as they are, in order. Where a component name
+  (or alias) is already in the merged library, the first is kept: the
+  name is removed from the later block, which is kept for any other
+  names - the first of which becomes its name, if its own was removed.
+  Returns the duplicates, one per name of each later file, as (name, LIB
+  file kept, duplicate's LIB file, identical) tuples - identical if the
+  LIB and DCM text blocks of the two are the same. The headers are as
+  for LibraryWriter.
+  """
+  duplicates = {}
+  lib_blocks = {}
+  dcm_blocks = {}
+  with LibraryWriter(lib_name, dcm_name, False, date_time,
+                     generator) as writer:
+    for shard_lib in lib_names:
+      shard_dcm = os.path.splitext(shard_lib)[0] + '.dcm'
+      for name, block_re, blocks, output in (
+          (shard_lib, lib_block_bytes_re, lib_blocks, 0),
+          (shard_dcm, dcm_block_bytes_re, dcm_blocks, 1)):
+        with open(name, 'rb') as f:
+          data = f.read()
+        for match in block_re.finditer(data):
+          block = match.group(0)
+          block_names = [match.group(1)]
+          alias_line = alias_line_bytes_re.search(block) if output == 0 \
+                       else None
+          if alias_line is not None:
+            block_names.extend(alias_line.group(1).split())
+
+          new_names = []
+          for block_name in block_names:
+            if block_name in blocks:
+              # (one duplicate, of its LIB and DCM blocks)
+              first_name, first_block = blocks[block_name]
+              key = (block_name, shard_lib)
+              identical = first_block == block
+              if key in duplicates:
+                identical = identical and duplicates[key][3]
+              duplicates[key] = (block_name.decode('utf-8'), first_name,
+                                 shard_lib, identical)
+            else:
+              new_names.append(block_name)
+          if not new_names:
+            continue
+
+          for block_name in new_names:
+            blocks[block_name] = (shard_lib, block)
+          output_blocks = ['', '']
+          output_blocks[output] = block.decode('utf-8').replace('\r\n',
+                                                                '\n')
+          if new_names != block_names:
+            # (only a LIB block has more than one name)
+            new_names = [block_name.decode('utf-8')
+                         for block_name in new_names]
+            output_blocks[output] = rename_lib_block(output_blocks[output],
+                                                     new_names[0],
+                                                     new_names[1:])
+          writer.write_component(*output_blocks)
+  return list(duplicates.values())
 
-  if header_flag == 0:
-    header_flag = 1
-    output_lib = template_lib_header.format(dtg =     date_time_group,
-                                            sfname = script_file_name,
-                                            filever = __version__)
+########################################################################
+# VERIFY >
+#
+# Checks a generated LIB and DCM pair in a single streaming pass. Each
+# DEF ... ENDDEF block is checked on its own (so, in parallel mode, by a
+# pool of worker processes), and the checks across the library - unique
+# names, DCM entries and pin counts - made as the results come back:
+# - pin numbers are unique within each component,
+# - no two pins of a unit share a position,
+# - every pin ends on the edge of a box of its unit, on the side it
+#   points from, and is in a unit of the component,
+# - every component (and alias) has a DCM entry, and vice versa,
+# - given the CSV headers, each component has as many pins as its
+#   header's pin count - less any exposed pad, eg VSS_PAD of a QFN,
+#   which is not counted there.
+
+# Pins not counted in the 'Pin count' of the CSV header
+exposed_pad_re = re.compile(r'_PAD$')
+
+# The direction in which a pin runs from its end to the box, by LIB pin
+# orientation
+pin_directions = {'R': (1, 0), 'L': (-1, 0), 'U': (0, 1), 'D': (0, -1)}
+
+def iter_lib_blocks(f):
+  """
+  Generate the DEF ... ENDDEF text blocks of an open LIB file, one at a
+  time.
+  """
+  block = None
+  for line in f:
+    if line.startswith('DEF '):
+      if block is not None:
+        # (without its ENDDEF)
+        yield ''.join(block)
+      block = [line]
+    elif block is not None:
+      block.append(line)
+      if line.startswith('ENDDEF'):
+        yield ''.join(block)
+        block = None
+  if block is not None:
+    yield ''.join(block)
+
+def pin_on_box(x, y, orientation, box):
+  """
+  Whether the inner end of a pin, at (x, y), is on the edge of a box
+  (x_min, y_min, x_max, y_max) - that it points away from.
+  """
+  x_min, y_min, x_max, y_max = box
+  if orientation == 'R':
+    return x == x_min and y_min <= y <= y_max
+  if orientation == 'L':
+    return x == x_max and y_min <= y <= y_max
+  if orientation == 'U':
+    return y == y_min and x_min <= x <= x_max
+  return y == y_max and x_min <= x <= x_max
+
+def check_lib_block(block):
+  """
+  Check one DEF ... ENDDEF text block of a LIB file. Returns its
+  component names (its own, then those of any aliases), its pin count
+  (less any exposed pad) and a list of the problems found.
+  """
+  names = []
+  problems = []
+  unit_count = 0
+  boxes = {}
+  pins = []
+
+  lines = block.splitlines()
+  for line in lines:
+    try:
+      if line.startswith('X '):
+        fields = line.split()
+        pins.append((fields[1], fields[2], int(fields[3]), int(fields[4]),
+                     int(fields[5]), fields[6], int(fields[9])))
+      elif line.startswith('S '):
+        x1, y1, x2, y2, unit = [int(field) for field in line.split()[1:6]]
+        boxes.setdefault(unit, []).append((min(x1, x2), min(y1, y2),
+                                           max(x1, x2), max(y1, y2)))
+      elif line.startswith('DEF '):
+        fields = line.split()
+        names.append(fields[1])
+        unit_count = int(fields[7])
+      elif line.startswith('ALIAS '):
+        names.extend(line.split()[1:])
+    except (ValueError, IndexError):
+      problems.append("malformed line '%s'" % line)
+
+  if not lines[-1].startswith('ENDDEF'):
+    problems.append("no ENDDEF")
+
+  numbers = set()
+  positions = set()
+  pad_count = 0
+  for label, number, x, y, length, orientation, unit in pins:
+    if number in numbers:
+      problems.append("pin number %s is not unique" % number)
+    numbers.add(number)
+
+    if (unit, x, y) in positions:
+      problems.append("pin %s shares position (%d, %d) in unit %d" %
+                      (number, x, y, unit))
+    positions.add((unit, x, y))
+
+    if not 0 <= unit <= unit_count:
+      problems.append("pin %s is in unit %d, of %d" %
+                      (number, unit, unit_count))
+
+    # (a pin of unit 0 is common to all units, as is a box)
+    dx, dy = pin_directions.get(orientation, (0, 0))
+    end_x, end_y = x + dx * length, y + dy * length
+    unit_boxes = boxes.get(unit, []) + boxes.get(0, []) if unit else \
+                 [box for unit_boxes in boxes.values() for box in unit_boxes]
+    if not any(pin_on_box(end_x, end_y, orientation, box)
+               for box in unit_boxes):
+      problems.append("pin %s at (%d, %d) does not end on the edge of "
+                      "its unit's box" % (number, x, y))
+
+    if exposed_pad_re.search(label.split('/', 1)[0]):
+      pad_count += 1
+
+  return names, len(pins) - pad_count, problems
+
+def read_pin_counts(f_in_list):
+  """
+  Return the pin count of the CSV header of each input source, by part
+  name - skipping any not in the expected format.
+  """
+  pin_counts = {}
+  for f_in in f_in_list:
+    try:
+      with open_device_csv(f_in) as f:
+        header = read_device_header(device_rows(f))
+    except DeviceFormatError:
+      continue
+    pin_counts[header[0]] = int(header[3])
+  return pin_counts
+
+def verify_library(lib_name, dcm_name=None, pin_counts=None, jobs=1):
+  """
+  Verify a LIB file, and its DCM file if named, in a single streaming
+  pass - checking the DEF blocks in a pool of 'jobs' worker processes,
+  where more than 1. Given pin_counts (see read_pin_counts), each
+  component's pins are counted against its CSV header. Returns the
+  number of components (DEF blocks) checked, and a list of the
+  problems found - empty if there are none.
+  """
+  problems = []
+  names = set()
+  component_count = 0
+
+  with open(lib_name, encoding='utf-8') as f:
+    if jobs > 1:
+      import multiprocessing
+      pool = multiprocessing.Pool(jobs)
+      results = pool.imap(check_lib_block, iter_lib_blocks(f), 32)
+    else:
+      pool = None
+      results = map(check_lib_block, iter_lib_blocks(f))
+
+    try:
+      for block_names, pin_count, block_problems in results:
+        component_count += 1
+        name = block_names[0] if block_names else '?'
+        problems.extend(['%s: %s' % (name, problem)
+                         for problem in block_problems])
+
+        for name in block_names:
+          if name in names:
+            problems.append('%s: more than one component of this name' %
+                            name)
+          names.add(name)
+          expected = pin_counts.get(name) if pin_counts else None
+          if expected is not None and expected != pin_count:
+            problems.append('%s: %d pins, but a pin count of %d in its '
+                            'CSV header' % (name, pin_count, expected))
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+  if dcm_name is not None:
+    with open(dcm_name, encoding='utf-8') as f:
+      dcm_names = set(line[5:].strip() for line in f
+                      if line.startswith('$CMP '))
+    problems.extend(['%s: no DCM entry' % name
+                     for name in sorted(names - dcm_names)])
+    problems.extend(['%s: DCM entry, but no component' % name
+                     for name in sorted(dcm_names - names)])
+
+  return component_count, problems
 
-    output_dcm = template_dcm_header.format(dtg =     date_time_group,
-                                            sfname = script_file_name,
-                                            filever = __version__)
+########################################################################
+# CACHE >
 
-    f_out_lib.write(output_lib)
-    f_out_dcm.write(output_dcm)
+def source_digest():
+  """
+  Return a hash of the source of this module - so a cache entry written
+  by any other revision of the script, whose output may differ even at
+  the same __version__, is not reused. Empty if the source cannot be
+  read, eg when run from a frozen executable.
+  """
+  import hashlib
+  try:
+    with open(__file__, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  except (NameError, OSError):
+    return ''
+
+class ComponentCache(object):
+  """
+  A directory of rendered (LIB, DCM) text blocks, one pair of files per
+  device. Entries are keyed by a hash of the device CSV file together
+  with the script version and source (see source_digest), layout
+  constants, PowerLayout (by default, power_layout), UnitPartition (by
+  default, unit_partition), output format and templates, so an entry is
+  only reused while all of these are unchanged. The least recently used
+  entries are evicted once the cache grows beyond max_size bytes.
+  """
 
-  output_lib = template_lib_body.format(compname =      part_name,
-                                        footprint =     package,
-                                        refposx =       str(ref_pos_x),
-                                        refposy =       str(ref_pos_y),
-                                        nameposx =      str(name_pos_x),
-                                        nameposy =      str(name_pos_y),
-                                        comp_pin_data = final2)
+  def __init__(self, directory, max_size=64 * 1024 * 1024, layout=None,
+               partition=None, output_format='lib'):
+    self.directory = directory
+    self.max_size = max_size
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    # Everything other than the CSV file which determines the output
+    if layout is None:
+      layout = power_layout
+    if partition is None:
+      partition = unit_partition
+    self.salt = repr((__version__, source_digest(), unit4_width,
+                      pin_length, pin_y_spacing, pin_y_box_offset,
+                      layout.table, partition.table, output_format,
+                      template_lib_body, template_dcm_body,
+                      template_description, component_keywords,
+                      component_datasheet, sym_version))
+
+  def key(self, f_in):
+    """
+    Return the cache key of a device CSV file.
+    """
+    with open_device_file(f_in) as f:
+      return self.key_data(f.read())
+
+  def key_data(self, csv_data):
+    """
+    Return the cache key of the contents of a device CSV file, as bytes.
+    """
+    import hashlib
+    digest = hashlib.sha1(self.salt.encode('utf-8'))
+    digest.update(csv_data)
+    return digest.hexdigest()
+
+  def get(self, key):
+    """
+    Return the cached (LIB, DCM) text blocks for the key, or None.
+    """
+    path = os.path.join(self.directory, key)
+    try:
+      with open(path + '.lib', encoding='utf-8') as f:
+        output_lib = f.read()
+      with open(path + '.dcm', encoding='utf-8') as f:
+        output_dcm = f.read()
+    except OSError:
+      return None
+
+    # Mark the entry as recently used - if the cache is read only, it
+    # is still used, but may be evicted sooner
+    try:
+      os.utime(path + '.lib', None)
+    except OSError:
+      pass
+    return output_lib, output_dcm
+
+  def put(self, key, output):
+    """
+    Store the (LIB, DCM) text blocks under the key - unless the cache
+    cannot be written, eg is read only.
+    """
+    path = os.path.join(self.directory, key)
+    # Write the DCM first, so the entry is only found once complete
+    for ext, text in (('.dcm', output[1]), ('.lib', output[0])):
+      # (unique per process, as --jobs workers share the cache)
+      tmp_name = '%s%s.%d.tmp' % (path, ext, os.getpid())
+      try:
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+          f.write(text)
+        os.replace(tmp_name, path + ext)
+      except OSError:
+        try:
+          os.remove(tmp_name)
+        except OSError:
+          pass
+        return
+
+  def evict(self):
+    """
+    Remove the least recently used entries until the cache is no larger
+    than max_size bytes.
+    """
+    entries = []
+    total_size = 0
+    for filename in os.listdir(self.directory):
+      if not filename.endswith('.lib'):
+        continue
+      path = os.path.join(self.directory, filename[:-len('.lib')])
+      try:
+        size = (os.path.getsize(path + '.lib') +
+                os.path.getsize(path + '.dcm'))
+        entries.append((os.path.getmtime(path + '.lib'), size, path))
+      except OSError:
+        continue
+      total_size += size
+
+    entries.sort()
+    for mtime, size, path in entries:
+      if total_size <= self.max_size:
+        break
+      for ext in ('.lib', '.dcm'):
+        try:
+          os.remove(path + ext)
+        except OSError:
+          pass
+      total_size -= size
 
+########################################################################
+# WATCH >
 
-  output_dcm = template_dcm_body.format(compname =      part_name,
-                                        chipname =      chip_name,
-                                        footprint =     package,
-                                        fpsize =        package_dims)
+class InputWatcher(object):
+  """
+  Polls the device CSV files of a run for changes: the CSV files of a
+  directory, a single CSV file, or the members of a zip archive matching
+  a glob pattern. A file is only reported as changed once its content
+  has changed - its modification time and size are compared first, and
+  then a hash of its content (for a zip member, its CRC).
+  """
 
+  def __init__(self, f_in=None, pattern='*.csv'):
+    # (None for the current working directory)
+    self.f_in = f_in
+    self.pattern = pattern
+    self.zip_stat = None
+    self.signatures = {}
+    self.digests = {}
+    self.changes()
+
+  def scan(self):
+    """
+    Return the current {device: signature} of each device CSV file, or
+    None while a zip archive cannot be read, eg while it is rewritten.
+    """
+    if self.f_in is not None and self.f_in.endswith('.zip'):
+      import fnmatch, zipfile
+      try:
+        stat = os.stat(self.f_in)
+        zip_stat = (stat.st_mtime, stat.st_size)
+        if zip_stat == self.zip_stat:
+          return self.signatures
+        with zipfile.ZipFile(self.f_in) as archive:
+          signatures = dict(((self.f_in, info.filename),
+                             (info.CRC, info.file_size))
+                            for info in archive.infolist()
+                            if fnmatch.fnmatch(info.filename, self.pattern))
+      except (OSError, zipfile.BadZipFile):
+        return None
+      self.zip_stat = zip_stat
+      # Forget this process's open copy of the old archive
+      archive = zip_archives.pop((self.f_in, os.getpid()), None)
+      if archive is not None:
+        archive.close()
+      return signatures
+
+    if self.f_in is None:
+      f_in_list = [filename for filename in os.listdir(os.getcwd())
+                   if filename.endswith(".csv")]
+    else:
+      f_in_list = [self.f_in]
+    signatures = {}
+    for f_in in f_in_list:
+      try:
+        stat = os.stat(f_in)
+      except OSError:
+        continue
+      signatures[f_in] = (stat.st_mtime, stat.st_size)
+    return signatures
+
+  def changes(self):
+    """
+    Return the lists of devices (changed or added, removed) since the
+    last call.
+    """
+    signatures = self.scan()
+    if signatures is None:
+      return [], []
+
+    changed = []
+    for f_in, signature in signatures.items():
+      if self.signatures.get(f_in) == signature:
+        continue
+      if not isinstance(f_in, tuple):
+        # Confirm the content itself has changed
+        import hashlib
+        try:
+          with open(f_in, 'rb') as f:
+            digest = hashlib.sha1(f.read()).digest()
+        except OSError:
+          continue
+        if self.digests.get(f_in) == digest:
+          continue
+        self.digests[f_in] = digest
+      changed.append(f_in)
+
+    removed = [f_in for f_in in self.signatures if f_in not in signatures]
+    for f_in in removed:
+      self.digests.pop(f_in, None)
+
+    self.signatures = signatures
+    return sorted(changed, key=str), sorted(removed, key=str)
+
+def device_name(f_in):
+  """
+  Return the part name of a device, as read from its CSV file header.
+  """
+  with open_device_csv(f_in) as f:
+    return read_device_header(device_rows(f))[0]
 
-  f_out_lib.write(output_lib)
-  f_out_dcm.write(output_dcm)
+def lib_block_re(name):
+  """
+  Return a pattern matching the LIB text block of the named component.
+  """
+  return re.compile(r'^# %s\n#\nDEF %s .*?^ENDDEF\n#\n'
+                    % (re.escape(name), re.escape(name)), re.M | re.S)
 
-  f_out_lib.close()
-  f_out_dcm.close()
+def dcm_block_re(name):
+  """
+  Return a pattern matching the DCM text block of the named component.
+  """
+  return re.compile(r'^\$CMP %s\n.*?^\$ENDCMP\n#\n' % re.escape(name),
+                    re.M | re.S)
+
+def patch_blocks(text, patches, block_re, footer):
+  """
+  Return the text of a LIB or DCM file with its text blocks patched:
+  for each (name, block) of the patches, the named component's block is
+  replaced with the new block - or removed, if the block is None. A new
+  component's block is added at the end, before the footer.
+  """
+  for name, block in patches:
+    match = block_re(name).search(text) if name is not None else None
+    if match is not None:
+      text = text[:match.start()] + (block or '') + text[match.end():]
+    elif block is not None:
+      end = text.rindex(footer)
+      text = text[:end] + block + text[end:]
+  return text
+
+def patch_library(lib_name, dcm_name, updates):
+  """
+  Patch the components of an existing LIB and DCM file in place, given
+  a list of (old name, LIB block, DCM block) updates - see patch_blocks.
+  Each file is replaced atomically, as LibraryWriter does.
+  """
+  for name, block_re, footer, index in (
+      (lib_name, lib_block_re, template_lib_footer, 1),
+      (dcm_name, dcm_block_re, template_dcm_footer, 2)):
+    with open(name, encoding='utf-8') as f:
+      text = f.read()
+    text = patch_blocks(text, [(update[0], update[index])
+                               for update in updates], block_re, footer)
+    with open(name + '.tmp', 'w', encoding='utf-8') as f:
+      f.write(text)
+    os.replace(name + '.tmp', name)
+
+def efm2kicad_watch(watcher, lib_name, dcm_name, cache=None, interval=0.25,
+                    callback=None, index=False, layout=None,
+                    partition=None):
+  """
+  Poll the InputWatcher every 'interval' seconds until interrupted, and
+  on each change, convert only the changed devices and patch their
+  components in the LIB and DCM files - and, with index=True, rewrite
+  their sidecar index. The ComponentCache, if given, is evicted down to
+  its max_size after each change. The callback, if given, is called with
+  (device, component name, seconds taken - or the exception raised) for
+  each device converted, and (device, None, seconds taken) for each
+  device removed. For layout and partition, see component_from_rows.
+  """
+  import time
+
+  # The component name of each device, as last written
+  names = {}
+  for f_in in watcher.signatures:
+    try:
+      names[f_in] = device_name(f_in)
+    except Exception:
+      pass
+
+  while True:
+    time.sleep(interval)
+    changed, removed = watcher.changes()
+    if not changed and not removed:
+      continue
+
+    t = default_timer()
+    updates = []
+    for f_in in removed:
+      updates.append((names.pop(f_in, None), None, None))
+    results = []
+    for f_in in changed:
+      try:
+        output_lib, output_dcm = efm2kicad_convert(f_in, cache, None,
+                                                   layout, partition)
+      except Exception as e:
+        # Eg a file caught part way through being saved - it is
+        # converted again once it changes
+        results.append((f_in, names.get(f_in), e))
+        continue
+      name = alias_fingerprint(output_lib)[0]
+      updates.append((names.get(f_in), output_lib, output_dcm))
+      names[f_in] = name
+      results.append((f_in, name, None))
+
+    if updates:
+      patch_library(lib_name, dcm_name, updates)
+      if index:
+        write_index(lib_name, dcm_name)
+    if cache is not None and changed:
+      cache.evict()
+    seconds = default_timer() - t
+
+    if callback is not None:
+      for f_in in removed:
+        callback(f_in, None, seconds)
+      for f_in, name, error in results:
+        callback(f_in, name, error or seconds)
+
+########################################################################
+# PROFILING >
+
+class DeviceProfile(object):
+  """
+  The time taken by each conversion stage of one device, in seconds,
+  and counters of the pins processed, CSV fields rewritten by Stage 2
+  ('substitutions'), pin_fields and cache hits/misses and bytes
+  written.
+  """
+
+  def __init__(self, device):
+    self.device = device
+    self.stages = {}
+    self.counts = Counter()
+
+  def lap(self, stage, t):
+    """
+    Record the time since 't' against the stage, returning the time now.
+    """
+    now = default_timer()
+    self.stages[stage] = self.stages.get(stage, 0.0) + now - t
+    return now
+
+class RunProfile(object):
+  """
+  Collects the DeviceProfile of every device converted in a run. If a
+  callback is given, it is called with each DeviceProfile as it is
+  added - a hook for other tools to record or act upon the timings.
+  """
+
+  # Stages, in conversion order
+  stage_names = ('cache', 'read', 'tidy', 'place', 'boxes', 'render',
+                 'write')
+
+  def __init__(self, callback=None):
+    self.callback = callback
+    self.devices = []
+
+  def add(self, profile):
+    """
+    Add one device's DeviceProfile.
+    """
+    self.devices.append(profile)
+    if self.callback is not None:
+      self.callback(profile)
+
+  def write_component(self, writer, output_lib, output_dcm, profile):
+    """
+    Write a component with the LibraryWriter, timing it and counting the
+    bytes written, then add its DeviceProfile.
+    """
+    t = default_timer()
+    writer.write_component(output_lib, output_dcm)
+    profile.lap('write', t)
+    profile.counts['bytes'] += len(output_lib) + len(output_dcm)
+    self.add(profile)
+
+  def totals(self):
+    """
+    Return the total time of each stage, and the totals of each counter,
+    over all devices.
+    """
+    stages = Counter()
+    counts = Counter()
+    for profile in self.devices:
+      stages.update(profile.stages)
+      counts.update(profile.counts)
+    return stages, counts
+
+  def as_dict(self):
+    """
+    Return the totals and the per-device records, eg for JSON output.
+    """
+    stages, counts = self.totals()
+    return {'totals': {'stages': dict(stages), 'counts': dict(counts)},
+            'devices': [{'device': str(profile.device),
+                         'stages': profile.stages,
+                         'counts': dict(profile.counts)}
+                        for profile in self.devices]}
+
+  def report(self, slowest=5):
+    """
+    Return a text summary: the time taken by each stage, the counters,
+    and the slowest devices.
+    """
+    stages, counts = self.totals()
+    total = sum(stages.values())
+    devices = len(self.devices)
+
+    lines = ["Profile of %d device(s):" % devices,
+             "  %-8s %10s %6s %12s" % ('stage', 'seconds', '%',
+                                        'ms/device')]
+    for stage in self.stage_names:
+      if stage in stages:
+        lines.append("  %-8s %10.4f %6.1f %12.3f" % (stage, stages[stage],
+                     100.0 * stages[stage] / (total or 1),
+                     1000.0 * stages[stage] / devices))
+    lines.append("  %-8s %10.4f" % ('total', total))
+
+    lines.append("Counters:")
+    for name in sorted(counts):
+      lines.append("  %-16s %d" % (name, counts[name]))
+
+    lines.append("Slowest devices:")
+    ranked = sorted(self.devices, key=lambda p: -sum(p.stages.values()))
+    for profile in ranked[:slowest]:
+      lines.append("  %10.4f  %s" % (sum(profile.stages.values()),
+                                     profile.device))
+    return '\n'.join(lines) + '\n'
 
 ########################################################################
 # HELP >
@@ -709,7 +3276,9 @@ user_help = """
 The format of all csv input files must conform to layout shown in the
 snippet below, but only insofar as elemental device data is located
 in the rows and 'cells' as implied. Comments anchors; "//" are not
-necessary.
+necessary. The labels of the header rows and the column headings are
+checked, and files which do not conform are reported and skipped (or,
+with '--strict' or a single <inputfile.csv>, stop the conversion).
 
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~ BEGIN SNIPPET ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 //--------------------------------------------------------------------
@@ -783,63 +3352,270 @@ If no <inputfile.csv> is supplied, csv2kicad_energymicro processes all
 CSV files in the current working directory and informs the user of the
 (fixed) file names after processing is complete.
 
+A zip archive of CSV files may be supplied in place of <inputfile.csv>.
+Its CSV members are read directly from the archive, without extracting
+them, and written to the same (fixed) file names as above. The optional
+'-g GLOB' ('--glob GLOB') selects which members are converted, eg:
+  csv2kicad_energymicro.py -g 'csv/EFM32GG*.csv' CSV_Symbols.zip
+
+When processing all CSV files, the optional '-j N' ('--jobs N') converts
+them using a pool of N worker processes. The output files are identical
+to those of a serial run.
+
+The optional '-s PATH' ('--source PATH'), which may be repeated,
+converts the CSV files of each directory, zip archive or CSV file given,
+in place of <inputfile.csv>, eg from several mirrors at once:
+  csv2kicad_energymicro.py -s mirror1/csv -s mirror2/bundle.zip -j 4
+The sources are listed and read concurrently, and each device converted
+as soon as it is read, while those before it are written.
+
+The optional '--reproducible' writes byte for byte identical output for
+identical input: the CSV files are converted in sorted order, and the
+output is dated by SOURCE_DATE_EPOCH (if set, as it is in most
+reproducible build systems) or else 1970-01-01 00:00:00 UTC, eg:
+  SOURCE_DATE_EPOCH=1700000000 csv2kicad_energymicro.py --reproducible
+
+The optional '--format kicad_sym' writes a single KiCad 6+ symbol
+library (.kicad_sym), named as the .LIB file would be, in place of the
+.LIB and .DCM files. The documentation of each component is written to
+its symbol's properties.
+
 """
 
 ########################################################################
 # MAIN FUNCTION >
 
-# Output file names
-fdest_lib = "energymicro-efm32.lib"
-fdest_dcm = "energymicro-efm32.dcm"
-
-# A file counter for user feedback
-fcounter = 0
+def main(argv=None):
+  """
+  The command line: convert the CSV file(s) named by argv (by default,
+  sys.argv[1:]) and write the LIB and DCM files.
+  """
+  import argparse
 
-# Get the working directory
-working_dir = os.getcwd()
+  # Output file names
+  fdest_lib = "energymicro-efm32.lib"
+  fdest_dcm = "energymicro-efm32.dcm"
 
-if __name__ == "__main__" :
+  # A file counter for user feedback
+  fcounter = 0
 
   parser = argparse.ArgumentParser(
-  usage='%(prog)s [<inputfile.csv>]',
+  usage='%(prog)s [options] [<inputfile.csv> | <archive.zip>]',
   formatter_class=argparse.RawDescriptionHelpFormatter,
   description = user_help)
 
   parser.add_argument('inputfile', nargs = '?', help = 'An optional \
-                      csv file. if none is specified, all csv files in \
-                      the current working directory are processed.')
-
-  arguments = parser.parse_args()
+                      csv file, or zip archive of csv files. if none is \
+                      specified, all csv files in the current working \
+                      directory are processed.')
+
+  parser.add_argument('-j', '--jobs', type = int, default = 1,
+                      metavar = 'N', help = 'Convert the csv files in \
+                      the current working directory (or zip archive) \
+                      using a pool of N \
+                      worker processes. The output is identical to \
+                      that of a serial run. Default: 1.')
+
+  parser.add_argument('-s', '--source', action = 'append', default = [],
+                      metavar = 'PATH', help = 'Convert the csv files of \
+                      this directory, zip archive or csv file, in place \
+                      of the input file. May be repeated: the sources \
+                      are listed and read concurrently, and converted \
+                      as they are read. Where sources hold csv files of \
+                      the same name, only the first is converted.')
+
+  parser.add_argument('--in-flight', type = int, default = 32,
+                      metavar = 'N', help = 'With --source, read at \
+                      most N devices ahead of those written. Default: \
+                      32.')
+
+  parser.add_argument('--strict', action = 'store_true', help = 'Stop \
+                      at the first csv file not in the expected format, \
+                      rather than skipping it (and reporting it) and \
+                      converting the rest.')
+
+  parser.add_argument('-a', '--alias', action = 'store_true',
+                      help = 'Write components which are identical \
+                      other than in name, eg flash size variants, as \
+                      ALIASes of the first such component, rather than \
+                      as a full component each.')
+
+  parser.add_argument('--format', choices = ('lib', 'kicad_sym'),
+                      default = 'lib', help = 'Write a legacy LIB and \
+                      DCM pair ("lib"), or a single KiCad 6+ symbol \
+                      library ("kicad_sym"), which current KiCad loads \
+                      without converting it. Default: lib.')
+
+  parser.add_argument('--shard-by', choices = sorted(shard_fields),
+                      help = 'Write a library of each chip family \
+                      ("chip_name") or package ("package") of the csv \
+                      headers, in place of the one library: eg \
+                      energymicro-efm32-leopard-gecko.lib. With --jobs, \
+                      the shards are written in parallel.')
+
+  parser.add_argument('--merge', nargs = '+', metavar = 'LIB', help = \
+                      'Merge these LIB files (and the DCM file alongside \
+                      each), eg shards, into one library, without \
+                      converting any csv files. Where a component is in \
+                      more than one, the first is kept and the others \
+                      reported.')
+
+  parser.add_argument('--reproducible', action = 'store_true',
+                      help = 'Write identical output for identical \
+                      input: convert the csv files in sorted order, \
+                      name this script without its path, and date the \
+                      output by SOURCE_DATE_EPOCH if it is set, or \
+                      else 1970-01-01 00:00:00 (UTC).')
+
+  parser.add_argument('--cache', metavar = 'DIR', help = 'Keep the \
+                      generated components in this cache directory, and \
+                      reuse them for any csv file which has not changed \
+                      since, so only changed devices are converted.')
+
+  parser.add_argument('--cache-size', type = int, default = 64,
+                      metavar = 'MB', help = 'Maximum size of the cache \
+                      directory; the least recently used components are \
+                      removed beyond this. Default: 64.')
+
+  parser.add_argument('--power-layout', metavar = 'FILE', help = 'Place \
+                      the Unit 4 (power) pins by the rules in this JSON \
+                      file, rather than those for the EFM32 devices. \
+                      See power_layout_table in this script for its \
+                      structure.')
+
+  parser.add_argument('--units', metavar = 'FILE', help = 'Assign the \
+                      pins to units by the table in this JSON file, \
+                      rather than PA/PB, PC/PD, PE/PF and power. See \
+                      unit_partition_table in this script for its \
+                      structure.')
+
+  parser.add_argument('--max-unit-pins', type = int, metavar = 'N',
+                      help = 'Split any unit (other than the power \
+                      unit) of more than N pins into parts of near \
+                      equal size, each a unit of its own.')
+
+  parser.add_argument('-g', '--glob', default = '*.csv',
+                      help = 'When the input file is a zip archive, only \
+                      convert the members whose name matches this \
+                      pattern, eg "csv/EFM32GG*.csv". Default: "*.csv".')
+
+  parser.add_argument('-i', '--index', action = 'store_true',
+                      help = 'Also write a sidecar index (eg \
+                      energymicro-efm32.idx) of the byte offset and \
+                      length of each component in the LIB and DCM \
+                      files, for fast lookup of single components.')
+
+  parser.add_argument('--verify', action = 'store_true', help = 'After \
+                      writing the LIB and DCM files, verify them: unique \
+                      pin numbers and positions, each pin on the edge of \
+                      its unit, a DCM entry for each component, and as \
+                      many pins as the pin count of its csv header. Any \
+                      problems are listed.')
+
+  parser.add_argument('--verify-only', action = 'store_true', help = 'As \
+                      --verify, verifying the existing LIB and DCM files \
+                      against the csv files, without converting them.')
+
+  parser.add_argument('-w', '--watch', action = 'store_true',
+                      help = 'After writing the library, keep watching \
+                      the input csv file(s) or zip archive. Each device \
+                      which changes is converted again, and its \
+                      component patched in place in the LIB and DCM \
+                      files. Stop with Ctrl+C.')
+
+  parser.add_argument('--watch-interval', type = float, default = 0.25,
+                      metavar = 'SECONDS', help = 'How often --watch \
+                      checks for changes. Default: 0.25.')
+
+  parser.add_argument('-v', '--verbose', action = 'store_true',
+                      help = 'List the csv files as they are processed.')
+
+  parser.add_argument('--profile', action = 'store_true', help = 'Time \
+                      each conversion stage of each device, count the \
+                      pins processed, fields rewritten and bytes \
+                      written, and print a summary.')
+
+  parser.add_argument('--profile-json', metavar = 'FILE', help = 'As \
+                      --profile, also writing the per-device timings \
+                      and counters to FILE as JSON.')
+
+  parser.add_argument('--cprofile', metavar = 'FILE', help = 'Run the \
+                      conversion under cProfile, writing its statistics \
+                      to FILE and printing the top functions. (With \
+                      --jobs, only the writing process is profiled.)')
+
+  parser.add_argument('--tracemalloc', action = 'store_true',
+                      help = 'Trace memory allocations during the \
+                      conversion, and print the peak and the top \
+                      allocating lines.')
+
+  arguments = parser.parse_args(argv)
 
   f_in = arguments.inputfile
 
-  # If a file name argument is NOT supplied, process ALL CSV files in
-  # the working directory and write kicad data to .lib and .dcm files
-  if not sys.argv[1:]:
+  if arguments.jobs < 1:
+    parser.error("--jobs must be 1 or more.")
 
-    print "Working..."
+  if arguments.watch and arguments.alias:
+    parser.error("--watch cannot be used with --alias.")
 
-    # Clear the contents of the output files if they already exist
-    f_out_lib = open(fdest_lib, 'w')
-    f_out_lib.write('')
-    f_out_lib.close()
+  if arguments.source:
+    if f_in is not None:
+      parser.error("An input file cannot be given with --source.")
+    if arguments.watch:
+      parser.error("--watch cannot be used with --source.")
+    if arguments.in_flight < 1:
+      parser.error("--in-flight must be 1 or more.")
+    for source in arguments.source:
+      if not os.path.exists(source):
+        parser.error("%s: no such file or directory." % source)
 
-    f_out_dcm = open(fdest_dcm, 'w')
-    f_out_dcm.write('')
-    f_out_dcm.close()
+  if arguments.format == 'kicad_sym' and (arguments.watch or
+                                          arguments.index):
+    parser.error("--watch and --index cannot be used with --format \
+kicad_sym.")
 
-    # For each file in the working directory with a .csv extension
-    for filename in os.listdir(working_dir):
-      if filename.endswith(".csv"):
+  if arguments.format == 'kicad_sym' and (arguments.verify or
+                                          arguments.verify_only or
+                                          arguments.merge):
+    parser.error("--verify, --verify-only and --merge cannot be used with \
+--format kicad_sym.")
 
-        # Processed files counter
-        fcounter += 1
+  if arguments.shard_by and (arguments.watch or arguments.merge or
+                             arguments.profile or arguments.profile_json):
+    parser.error("--shard-by cannot be used with --watch, --merge or \
+--profile.")
 
-        if _debugflag == 2:
-          print filename
+  # The files of the sources given are only known once listed, as they
+  # are converted (see efm2kicad_ingest)
+  if arguments.source:
+
+    print("Working...")
+
+    f_in_list = None
+
+  # If a file name argument is NOT supplied, process ALL CSV files in
+  # the working directory and write kicad data to .lib and .dcm files.
+  # A zip archive is processed likewise, reading each CSV member
+  # directly from the archive.
+  elif f_in is None or f_in.endswith(".zip"):
+
+    if f_in is not None and not os.path.isfile(f_in):
+      raise IOError("\nPlease check the file exists.")
+
+    print("Working...")
+
+    if f_in is None:
+      # Each file in the working directory with a .csv extension
+      f_in_list = [filename for filename in os.listdir(os.getcwd())
+                   if filename.endswith(".csv")]
+    else:
+      # Each member of the zip archive matching the glob pattern
+      f_in_list = zip_members(f_in, arguments.glob)
+
+    # Processed files counter
+    fcounter = len(f_in_list)
 
-        # Call the primary data generating function
-        efm2kicad_generator(filename)
 
   # If a CSV file name argument IS supplied, reflect that name in the
   # output file names, replacing the .csv with .lib and .dcm
@@ -851,11 +3627,12 @@ if __name__ == "__main__" :
 
     else:
       if not f_in.endswith(".csv"):
-        raise IOError("\nPlease provide a file with a .csv extension.")
+        raise IOError("\nPlease provide a file with a .csv or .zip \
+extension.")
 
       # The name of the lib and dcm files is based on the input file
       # (Match any character - match the dot - match any character)
-      foutname = re.match('(.*)\..*', f_in)
+      foutname = re.match(r'(.*)\..*', f_in)
 
       # Create the destination library file name
       fdest_lib = (str(foutname.group(1))+ '.lib')
@@ -863,39 +3640,286 @@ if __name__ == "__main__" :
        # Create the destination documentation file name
       fdest_dcm = (str(foutname.group(1))+ '.dcm')
 
-      # Clear the contents of the output files if they already exist
-      f_out_lib = open(fdest_lib, 'w')
-      f_out_lib.write('')
-      f_out_lib.close()
+      f_in_list = [f_in]
 
-      f_out_dcm = open(fdest_dcm, 'w')
-      f_out_dcm.write('')
-      f_out_dcm.close()
+      fcounter = 1
 
-      # Call the main data conversion function
-      efm2kicad_generator(f_in)
+  # Where needed before converting, list the files of the sources given
+  if f_in_list is None and (arguments.shard_by or arguments.merge or
+                            arguments.verify_only):
+    f_in_list = [filename for source in arguments.source
+                 for filename in discover_inputs(source, arguments.glob)]
+    fcounter = len(f_in_list)
+
+  # Reproducible output does not depend on the order in which the
+  # directory (or archive) lists the files
+  if arguments.reproducible and f_in_list is not None:
+    f_in_list.sort()
+
+  # When processing many CSV files, any not in the expected format are
+  # reported and skipped, unless strict - when the first stops the
+  # conversion, naming its file
+  skipped = []
+
+  def skip_device(f_in, error):
+    device = ':'.join(f_in) if isinstance(f_in, tuple) else f_in
+    sys.stderr.write("%s: skipped - %s\n" % (device, error))
+    skipped.append(f_in)
+
+  def stop_device(f_in, error):
+    device = ':'.join(f_in) if isinstance(f_in, tuple) else f_in
+    raise DeviceFormatError("%s: %s" % (device, error))
+
+  if arguments.strict or (f_in is not None and f_in.endswith(".csv")):
+    on_error = stop_device
+  else:
+    on_error = skip_device
+
+  # The output is dated by SOURCE_DATE_EPOCH, where set, and names this
+  # script without its path where reproducible
+  try:
+    date_time = source_date_time(arguments.reproducible)
+  except ValueError as e:
+    parser.error(str(e))
+  if arguments.reproducible:
+    generator = os.path.basename(sys.argv[0])
+  else:
+    generator = None
+
+  # The symbol library is named as the LIB file would be
+  fdest_sym = os.path.splitext(fdest_lib)[0] + '.kicad_sym'
+
+  # Verify the LIB and DCM files, counting the pins against the CSV
+  # headers of the input files
+  def verify_output(f_in_list, lib_name=fdest_lib, dcm_name=fdest_dcm):
+    component_count, problems = verify_library(lib_name, dcm_name,
+                                               read_pin_counts(f_in_list),
+                                               arguments.jobs)
+    for problem in problems:
+      print(problem)
+    print("%s: %d components verified, %d problem(s) found.\n" %
+          (lib_name, component_count, len(problems)))
+    return len(problems)
+
+  if arguments.verify_only:
+    if verify_output(f_in_list):
+      return 1
+    return
+
+  if arguments.merge:
+    for lib_name in arguments.merge:
+      if os.path.abspath(lib_name) == os.path.abspath(fdest_lib):
+        parser.error("%s cannot be merged into itself." % lib_name)
+    duplicates = merge_libraries(arguments.merge, fdest_lib, fdest_dcm,
+                                 date_time, generator)
+    for name, first_name, duplicate_name, identical in duplicates:
+      print("%s: in %s and %s - the first kept%s" %
+            (name, first_name, duplicate_name,
+             "" if identical else ", but the two differ"))
+    print("\n%d libraries were merged, with %d duplicate(s).\n\
+The following two files were created or updated:\n%s\n%s\n" %
+          (len(arguments.merge), len(duplicates), fdest_lib, fdest_dcm))
+
+    if arguments.index:
+      write_index(fdest_lib, fdest_dcm)
+    if arguments.verify:
+      problem_count = verify_output(f_in_list)
+    else:
+      problem_count = 0
+
+    # (differing duplicates are a problem, identical ones are not)
+    if problem_count or not all([duplicate[3]
+                                 for duplicate in duplicates]):
+      return 1
+    return
+
+  if arguments.power_layout:
+    try:
+      layout = load_power_layout(arguments.power_layout)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+      parser.error(str(e))
+  else:
+    layout = power_layout
+
+  if arguments.units or arguments.max_unit_pins is not None:
+    try:
+      partition = load_unit_partition(arguments.units,
+                                      arguments.max_unit_pins)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+      parser.error(str(e))
+  else:
+    partition = unit_partition
 
-      fcounter = 1
+  if arguments.cache:
+    cache = ComponentCache(arguments.cache,
+                           arguments.cache_size * 1024 * 1024, layout,
+                           partition, arguments.format)
+  else:
+    cache = None
 
-  # Write the library file footer
-  f_out_lib = open(fdest_lib, 'a')
-  f_out_lib.write(template_lib_footer)
-  f_out_lib.close()
+  if arguments.profile or arguments.profile_json:
+    if arguments.verbose:
+      # List each file as its profile is recorded
+      run_profile = RunProfile(lambda profile: sys.stdout.write(
+                               "%s\n" % (profile.device,)))
+    else:
+      run_profile = RunProfile()
+  else:
+    run_profile = None
+    if arguments.verbose and f_in_list is not None:
+      for filename in f_in_list:
+        print(filename)
+
+  # Note the state of the input before it is converted, so no change
+  # made meanwhile is missed
+  if arguments.watch:
+    watcher = InputWatcher(f_in, arguments.glob)
+
+  if arguments.cprofile:
+    import cProfile, pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+  if arguments.tracemalloc:
+    import tracemalloc
+    tracemalloc.start()
+
+  # Write the library and documentation files (or symbol library) - or
+  # those of each shard. Any existing files are only replaced once all
+  # of the output has been written.
+  try:
+    if arguments.shard_by:
+      shards = shard_inputs(f_in_list, arguments.shard_by, on_error)
+      fdest_names = [name for names in efm2kicad_shards(
+                       shards, fdest_lib, arguments.jobs, cache, layout,
+                       partition, arguments.format, arguments.alias,
+                       date_time, generator, on_error)
+                     for name in names]
 
-  # Write the documentation file footer
-  f_out_dcm = open(fdest_dcm, 'a')
-  f_out_dcm.write(template_dcm_footer)
-  f_out_dcm.close()
+    else:
+      if arguments.format == 'kicad_sym':
+        writer = SymbolLibraryWriter(fdest_sym, arguments.alias, generator)
+        fdest_names = [fdest_sym]
+      else:
+        writer = LibraryWriter(fdest_lib, fdest_dcm, arguments.alias,
+                               date_time, generator)
+        fdest_names = [fdest_lib, fdest_dcm]
+
+      with writer:
+
+        if arguments.source:
+          # List, read and convert the sources concurrently, writing them in
+          # order
+          if arguments.verbose and run_profile is None:
+            callback = print
+          else:
+            callback = None
+          f_in_list = efm2kicad_ingest(arguments.source, writer,
+                                       arguments.jobs, arguments.glob,
+                                       arguments.in_flight, cache, run_profile,
+                                       layout, partition, arguments.format,
+                                       arguments.reproducible, callback,
+                                       on_error)
+          fcounter = len(f_in_list)
+
+        elif arguments.jobs > 1:
+          # Convert the files in parallel, writing them in the same order
+          efm2kicad_batch(f_in_list, arguments.jobs, writer, cache,
+                          run_profile, layout, partition, arguments.format,
+                          on_error)
+
+        else:
+          for filename in f_in_list:
+            # Call the primary data generating function
+            efm2kicad_generator(filename, writer, cache, run_profile, layout,
+                                partition, arguments.format, on_error)
+  except DeviceFormatError as e:
+    sys.stderr.write("%s\n" % e)
+    return 1
+
+  # (a LIB and DCM file of each shard, if sharded)
+  fdest_pairs = list(zip(fdest_names[0::2], fdest_names[1::2]))
+
+  if arguments.index:
+    for lib_name, dcm_name in fdest_pairs:
+      write_index(lib_name, dcm_name)
+
+  if arguments.tracemalloc:
+    snapshot = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("\nPeak traced memory: %d KiB\nTop allocations:" % (peak // 1024))
+    for stat in snapshot.statistics('lineno')[:10]:
+      print("  %s" % stat)
+
+  if arguments.cprofile:
+    profiler.disable()
+    profiler.dump_stats(arguments.cprofile)
+    print("\ncProfile statistics written to %s:" % arguments.cprofile)
+    pstats.Stats(arguments.cprofile).sort_stats('cumulative').print_stats(15)
+
+  if run_profile is not None:
+    print("\n" + run_profile.report())
+    if arguments.profile_json:
+      import json
+      with open(arguments.profile_json, 'w') as f:
+        json.dump(run_profile.as_dict(), f, indent=2, sort_keys=True)
+
+  if cache is not None:
+    cache.evict()
 
   # Provide some feedback about what was processed,
   # and name of the new library files.
+  fcounter -= len(skipped)
   if fcounter > 1:
     outsubstring = " CSV files were "
   else:
     outsubstring = " CSV file was "
 
-  print "\n"+ str(fcounter) + outsubstring +"processed.\n\
-The following two files were created or updated:\n" +\
-fdest_lib + "\n" + fdest_dcm + "\n\n"
+  if len(fdest_names) > 2:
+    outfiles = "The following %d files were" % len(fdest_names)
+  elif len(fdest_names) > 1:
+    outfiles = "The following two files were"
+  else:
+    outfiles = "The following file was"
+
+  print("\n"+ str(fcounter) + outsubstring +"processed.\n" +\
+outfiles + " created or updated:\n" + "\n".join(fdest_names) + "\n\n")
+
+  if skipped:
+    print(str(len(skipped)) + " CSV file(s) not in the expected format \
+were skipped (see above).\n")
+
+  problem_count = 0
+  if arguments.verify:
+    for lib_name, dcm_name in fdest_pairs:
+      problem_count += verify_output(f_in_list, lib_name, dcm_name)
+
+  if arguments.watch:
+    print("Watching for changes... (Ctrl+C to stop)")
+
+    def watch_report(f_in, name, result):
+      device = ':'.join(f_in) if isinstance(f_in, tuple) else f_in
+      if isinstance(result, Exception):
+        print("%s: not converted - %s" % (device, result))
+      elif name is None:
+        print("%s: removed (%d ms)" % (device, result * 1000))
+      else:
+        print("%s: %s updated (%d ms)" % (device, name, result * 1000))
+      sys.stdout.flush()
+
+    try:
+      efm2kicad_watch(watcher, fdest_lib, fdest_dcm, cache,
+                      arguments.watch_interval, watch_report,
+                      arguments.index, layout, partition)
+    except KeyboardInterrupt:
+      pass
+
+  # (a non-zero exit status, for batch jobs)
+  if skipped or problem_count:
+    return 1
+
+if __name__ == "__main__" :
+  sys.exit(main())
 
 ########################################################################